@@ -0,0 +1,373 @@
+from __future__ import annotations
+import os, sys, time, random, asyncio, logging, tempfile, itertools
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+import discord
+import bot
+
+def _timed(fn: Callable, args) -> float:
+    t0 = time.perf_counter()
+    for a in args:
+        fn(a)
+    return (time.perf_counter() - t0) / max(1, len(args)) * 1e6
+
+def bench_ruby(n: int = 2000):
+    reqs = random.Random(0).sample(range(1, 90_000), n)
+    t0 = time.perf_counter()
+    bot._ruby_table.cache_clear(); bot.best_ruby_cost_for_charters.cache_clear()
+    bot._ruby_table()
+    build_ms = (time.perf_counter() - t0) * 1000
+    greedy_us = _timed(bot._greedy_ruby_cost_for_charters, reqs)
+    cold_us = _timed(bot.best_ruby_cost_for_charters, reqs)
+    warm_us = _timed(bot.best_ruby_cost_for_charters, reqs[-500:] * 4)
+    better = 0; saved = 0; worst = 0
+    for r in reqs:
+        g = bot._greedy_ruby_cost_for_charters(r)[0]; e = bot.best_ruby_cost_for_charters(r)[0]
+        if e > g:
+            raise AssertionError(f"planer dokładny droższy niż zachłanny dla {r}: {e} > {g}")
+        if e < g:
+            better += 1; saved += g - e; worst = max(worst, g - e)
+    print(f"ruby: tablica {build_ms:.1f} ms | zachłanny {greedy_us:.1f} µs/plan | dokładny {cold_us:.1f} µs (zimny), {warm_us:.2f} µs (LRU)")
+    print(f"ruby: taniej w {better}/{n} planach, średnio -{saved/max(1,better):,.0f} rub., maks. -{worst:,} rub.")
+
+def _walk_levels_stepwise(lv, prog, gain):
+    C = bot.LEVEL_COSTS
+    lv = max(0, min(10, int(lv))); prog = float(max(0, prog)); pool = float(max(0, gain))
+    if lv >= 10: return 10, 0.0, None, prog + pool
+    while lv < 10:
+        need = C[lv] - prog
+        if pool >= need:
+            pool -= need; lv += 1; prog = 0.0
+        else:
+            prog += pool; pool = 0.0; break
+        if lv == 10: return 10, 0.0, None, pool
+    return lv, prog, (C[lv] - prog if lv < 10 else None), None
+
+def _points_to_level_stepwise(lv, prog, target):
+    if lv >= 10: return 0
+    need = bot.LEVEL_COSTS[lv] - prog
+    for L in range(lv + 1, target):
+        need += bot.LEVEL_COSTS[L]
+    return need
+
+def bench_levels(n: int = 200_000):
+    rnd = random.Random(0); cases = []
+    for i in range(n):
+        lv = rnd.randrange(-1, 12); prog = rnd.choice([0, rnd.randrange(30_000), rnd.random() * 30_000])
+        gain = rnd.choice([0, rnd.randrange(100_000), rnd.random() * 100_000])
+        if i % 5 == 0:
+            gain = float(bot.LEVEL_CUM[rnd.randrange(11)] - bot.LEVEL_CUM[max(0, min(10, lv))] + rnd.choice([0, 1, -1])) - prog
+        cases.append((lv, prog, gain))
+    for lv, prog, gain in cases:
+        a = _walk_levels_stepwise(lv, prog, gain); b = bot.walk_levels(lv, prog, gain)
+        if a != b:
+            raise AssertionError(f"walk_levels{(lv, prog, gain)}: {b} != {a}")
+        if b[2] is not None:
+            t = rnd.randrange(0, 11)
+            x = _points_to_level_stepwise(b[0], b[1], t); y = bot.points_to_level(b[0], b[1], t)
+            if abs(x - y) > 1e-9 * max(1.0, abs(x)):
+                raise AssertionError(f"points_to_level{(b[0], b[1], t)}: {y} != {x}")
+    old_us = _timed(lambda c: _walk_levels_stepwise(*c), cases)
+    new_us = _timed(lambda c: bot.walk_levels(*c), cases)
+    print(f"levels: {n} przypadków zgodnych | krokowo {old_us:.2f} µs | prefiksy {new_us:.2f} µs")
+
+def bench_berimond(top: int = 400_000, step: int = 3):
+    rows = list(range(0, top + 1, step)); th = bot.BERI_THRESHOLDS
+    for cur in rows:
+        a = [bot.days_until_below_berimond(cur, t) for t in th]; b = bot.berimond_days_many(cur, th)
+        if a != b:
+            raise AssertionError(f"berimond({cur}): {b} != {a}")
+    old_us = _timed(lambda c: [bot.days_until_below_berimond(c, t) for t in th], rows)
+    new_us = _timed(lambda c: bot.berimond_days_many(c, th), rows)
+    t0 = time.perf_counter(); bot.berimond_days_batch(rows, th); batch_ms = (time.perf_counter() - t0) * 1000
+    print(f"berimond: {len(rows)} graczy zgodnych | 3× osobno {old_us:.2f} µs | jednym przebiegiem {new_us:.2f} µs | batch {batch_ms:.0f} ms")
+
+class FakeREST:
+    def __init__(self, latency: float = 0.001, bucket: int = 25, window: float = 0.01):
+        self.latency = latency; self.bucket = bucket; self.window = window
+        self.calls: Dict[str, int] = {}; self.limited = 0
+        self._windows: Dict[str, List[float]] = {}
+
+    async def call(self, route: str):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        w = self._windows.setdefault(route, [0.0, 0])
+        while True:
+            now = time.perf_counter()
+            if now - w[0] >= self.window:
+                w[0], w[1] = now, 0
+            if w[1] < self.bucket:
+                w[1] += 1
+                break
+            self.limited += 1
+            await asyncio.sleep(w[0] + self.window - now)
+        await asyncio.sleep(self.latency)
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+_SEQ = itertools.count()
+
+def _snowflake(dt: datetime) -> int:
+    return ((int(dt.timestamp() * 1000) - discord.utils.DISCORD_EPOCH) << 22) | (next(_SEQ) & 0x3FFFFF)
+
+class FakeUser:
+    def __init__(self, uid: int, is_bot: bool = False):
+        self.id = uid; self.bot = is_bot; self.roles: List[FakeRole] = []
+
+class FakeRole:
+    def __init__(self, guild: "FakeGuild", rid: int):
+        self.guild = guild; self.id = rid
+
+    @property
+    def members(self) -> List[FakeUser]:
+        return [m for m in self.guild.members.values() if self in m.roles]
+
+class FakeReaction:
+    def __init__(self, rest: FakeREST, emoji: str):
+        self.rest = rest; self.emoji = emoji; self.users_: Dict[int, FakeUser] = {}
+
+    async def users(self, limit=None):
+        items = list(self.users_.values())
+        for k in range(0, max(1, len(items)), 100):
+            await self.rest.call("GET reactions")
+            for u in items[k:k + 100]:
+                yield u
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str = "", created_at: Optional[datetime] = None):
+        self.channel = channel; self.guild = channel.guild; self.author = author; self.content = content; self.embeds: list = []
+        self.created_at = created_at or datetime.now(timezone.utc); self.id = _snowflake(self.created_at)
+        self.reactions: List[FakeReaction] = []
+
+    def snapshot(self) -> "FakeMessage":
+        # jak discord.Message: lista reakcji zamrożona w chwili pobrania, lista użytkowników zawsze z API
+        m = object.__new__(FakeMessage); m.__dict__.update(self.__dict__); m.reactions = list(self.reactions)
+        return m
+
+    def _reaction(self, emoji: str) -> Optional[FakeReaction]:
+        return next((r for r in self.reactions if r.emoji == emoji), None)
+
+    async def add_reaction(self, emoji: str):
+        await self.channel.rest.call("PUT reaction")
+        r = self._reaction(emoji)
+        if r is None:
+            r = FakeReaction(self.channel.rest, emoji); self.reactions.append(r)
+        r.users_[bot.SELF_BOT_ID] = FakeUser(bot.SELF_BOT_ID, True)
+
+    async def remove_reaction(self, emoji: str, member):
+        await self.channel.rest.call("DELETE reaction user")
+        r = self._reaction(emoji)
+        if r: r.users_.pop(member.id, None)
+
+    async def clear_reaction(self, emoji: str):
+        if not self.channel.manage_messages:
+            raise discord.Forbidden(type("R", (), {"status": 403, "reason": "Forbidden"})(), "Missing Permissions")
+        await self.channel.rest.call("DELETE reaction emoji")
+        r = self._reaction(emoji)
+        if r: self.reactions.remove(r)
+
+class FakeChannel:
+    type = discord.ChannelType.text
+
+    def __init__(self, guild: "FakeGuild", cid: int, rest: FakeREST):
+        self.guild = guild; self.id = cid; self.rest = rest
+        self.messages: List[FakeMessage] = []; self.sent: List[Tuple[float, str]] = []; self.manage_messages = True
+
+    def permissions_for(self, obj):
+        return type("P", (), {"manage_messages": self.manage_messages})()
+
+    def get_partial_message(self, mid: int):
+        return self.by_id(mid)
+
+    def by_id(self, mid: int) -> FakeMessage:
+        return next(m for m in self.messages if m.id == mid)
+
+    async def fetch_message(self, mid: int):
+        await self.rest.call("GET message")
+        return self.by_id(mid).snapshot()
+
+    async def send(self, content: str):
+        await self.rest.call("POST message")
+        self.sent.append((time.perf_counter(), content))
+        m = FakeMessage(self, FakeUser(bot.SELF_BOT_ID, True), content); self.messages.append(m)
+        return m.snapshot()
+
+    async def history(self, limit=100, after=None, oldest_first=None):
+        picked = [m for m in reversed(self.messages) if after is None or m.created_at > after][:limit]
+        for k in range(0, max(1, len(picked)), 100):
+            await self.rest.call("GET messages")
+            for m in picked[k:k + 100]:
+                yield m
+
+class FakeGuild:
+    def __init__(self, rest: FakeREST):
+        self.id = bot.MAIN_GUILD_ID; self.rest = rest; self.me = FakeUser(bot.SELF_BOT_ID, True)
+        self.members: Dict[int, FakeUser] = {}
+        self.roles = {rid: FakeRole(self, rid) for rid in bot.EMOJI_TO_ROLE.values()}
+        self.channels = {cid: FakeChannel(self, cid, rest) for cid in (bot.EM_CHANNEL_ID, bot.SIGNUP_CHANNEL_ID)}
+
+    def get_role(self, rid): return self.roles.get(rid)
+    def get_member(self, uid): return self.members.get(uid)
+    def get_channel(self, cid): return self.channels.get(cid)
+
+    async def fetch_member(self, uid):
+        await self.rest.call("GET member")
+        return self.members[uid]
+
+class FakeHTTP:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+
+    async def add_role(self, gid, uid, rid, reason=None):
+        await self.guild.rest.call("PUT member role")
+        m = self.guild.members.setdefault(uid, FakeUser(uid)); r = self.guild.roles[rid]
+        if r not in m.roles: m.roles.append(r)
+
+    async def remove_role(self, gid, uid, rid, reason=None):
+        await self.guild.rest.call("DELETE member role")
+        m = self.guild.members.get(uid); r = self.guild.roles[rid]
+        if m and r in m.roles: m.roles.remove(r)
+
+STATE_PATH = os.path.join(tempfile.gettempdir(), f"bench_state_{os.getpid()}.sqlite3")
+
+def fake_client(signups: int, rest: FakeREST, cached: float = 1.0, state_path: str = STATE_PATH) -> Tuple["bot.MyClient", FakeGuild]:
+    guild = FakeGuild(rest)
+    c = bot.MyClient()
+    c.state.path = state_path
+    c.get_guild = lambda gid: guild if gid == guild.id else None  # type: ignore
+    c.http = FakeHTTP(guild)  # type: ignore
+    c._connection.user = guild.me  # type: ignore
+    c.start_time = datetime.now(timezone.utc) - timedelta(hours=1); c.catchup = False
+    signup_ch = guild.channels[bot.SIGNUP_CHANNEL_ID]
+    msg = FakeMessage(signup_ch, guild.me, bot.SIGNUP_TEXT); signup_ch.messages.append(msg)
+    for em in bot.EMOJI_TO_ROLE:
+        r = FakeReaction(rest, em); r.users_[guild.me.id] = guild.me; msg.reactions.append(r)
+    pt = c.primetime.by_guild[guild.id]
+    c.primetime.bind(pt, msg.id)
+    role = guild.roles[bot.ROLE_PREMKA300]
+    for k in range(signups):
+        u = FakeUser(10_000 + k); u.roles.append(role)
+        if k < signups * cached:
+            guild.members[u.id] = u
+        msg.reactions[0].users_[u.id] = u
+        pt.pending[bot.ROLE_PREMKA300].add(u.id)
+    return c, guild
+
+def _em(guild: FakeGuild, text: str) -> FakeMessage:
+    ch = guild.channels[bot.EM_CHANNEL_ID]
+    m = FakeMessage(ch, FakeUser(42, True), text); ch.messages.append(m)
+    return m
+
+def _calls(rest: FakeREST) -> str:
+    return ", ".join(f"{k}={v}" for k, v in sorted(rest.calls.items()))
+
+# scenariusze zwracają (rest, guild, ...) — bench_primetime je wypisuje, test_primetime.py sprawdza rest.calls
+async def ping_scenario(n: int, manage: bool, **kw) -> Tuple[FakeREST, FakeGuild, float, float]:
+    rest = FakeREST(); c, g = fake_client(n, rest, **kw)
+    g.channels[bot.SIGNUP_CHANNEL_ID].manage_messages = manage
+    em = g.channels[bot.EM_CHANNEL_ID]
+    t0 = time.perf_counter()
+    await c._handle_em_message(_em(g, bot.MATCH_300GL[0]))
+    wall = time.perf_counter() - t0
+    ping_ms = (em.sent[0][0] - t0) * 1000 if em.sent else float("nan")
+    return rest, g, ping_ms, wall
+
+async def sync_scenario(n: int, **kw) -> Tuple[FakeREST, FakeGuild, float]:
+    rest = FakeREST(); c, g = fake_client(n, rest, **kw)
+    msg = g.channels[bot.SIGNUP_CHANNEL_ID].messages[0]
+    stale = list(msg.reactions[0].users_.values())[1:n // 10 + 1]
+    for u in stale: msg.reactions[0].users_.pop(u.id)
+    for k in range(n // 10):
+        u = FakeUser(900_000 + k); g.members[u.id] = u; msg.reactions[1].users_[u.id] = u
+    t0 = time.perf_counter()
+    await c.sync_roles_from_reactions(c.primetime.by_guild[g.id])
+    return rest, g, time.perf_counter() - t0
+
+async def burst_scenario(n: int, burst: int, **kw) -> Tuple[FakeREST, FakeGuild, float]:
+    rest = FakeREST(); c, g = fake_client(n, rest, **kw)
+    texts = [bot.MATCH_300GL[0], bot.MATCH_200OR[0], bot.MATCH_200BTH[0]] + ["Zwykła wiadomość"] * 7
+    msgs = [_em(g, texts[k % len(texts)]) for k in range(burst)]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(c._handle_em_message(m) for m in msgs))
+    return rest, g, time.perf_counter() - t0
+
+def _classify_linear(c: "bot.MyClient", msg) -> Optional[int]:
+    t = c._msg_text(msg)
+    if any(s in t for s in bot.MATCH_300GL): return bot.ROLE_PREMKA300
+    if any(s in t for s in bot.MATCH_200OR): return bot.ROLE_PREMKAZWK
+    if any(s in t for s in bot.MATCH_200BTH): return bot.ROLE_PREMKAHORY
+    return None
+
+def _embed_history(n: int, fields: int, seed: int = 0) -> list:
+    rnd = random.Random(seed); words = "castle lord alliance berimond ruby glory event realm tower horizon".split()
+    texts = [bot.MATCH_300GL[1], bot.MATCH_200OR[0], bot.MATCH_200BTH[0]]
+    out = []
+    for k in range(n):
+        filler = lambda m: " ".join(rnd.choice(words) for _ in range(m))
+        e = discord.Embed(title=filler(4), description=filler(60))
+        for _ in range(fields):
+            e.add_field(name=filler(2), value=filler(20))
+        e.set_footer(text=filler(5)); e.set_author(name=filler(2))
+        content = ""
+        if k % 50 == 0: content = texts[k // 50 % 3]
+        elif k % 50 == 25: e.add_field(name="EM", value=texts[k // 50 % 3])
+        out.append(type("M", (), {"author": FakeUser(42, True), "content": content, "embeds": [e] * 2})())
+    return out
+
+def bench_classify(n: int = 5_000, fields: int = 10):
+    c = bot.MyClient.__new__(bot.MyClient); c._connection = type("S", (), {"user": None})()
+    pt = bot.PrimeTimeIndex.load("").by_guild[bot.MAIN_GUILD_ID]
+    msgs = _embed_history(n, fields)
+    for m in msgs:
+        if _classify_linear(c, m) != pt.classify(m):
+            raise AssertionError(f"różna klasyfikacja: {m.content!r}")
+    old_us = _timed(lambda m: _classify_linear(c, m), msgs)
+    new_us = _timed(pt.classify, msgs)
+    hits = sum(1 for m in msgs if pt.classify(m))
+    print(f"classify n={n} ({fields} pól x 2 embedy): liniowy {old_us:.1f} µs/wiad. | matcher {new_us:.1f} µs/wiad. | trafień {hits}")
+
+async def startup_scenario(n: int, **kw) -> Tuple[FakeREST, FakeGuild, float, float]:
+    rest = FakeREST(); c, g = fake_client(n, rest, **kw)
+    g.chunked = True
+    async def presence(**kw): await rest.call("PATCH presence")
+    c.change_presence = presence  # type: ignore
+    _em(g, bot.MATCH_300GL[0])
+    c.start_time = datetime.now(timezone.utc)
+    t0 = time.perf_counter()
+    await c.on_ready()
+    ready = time.perf_counter() - t0
+    while c.first_ping_at is None and time.perf_counter() - t0 < 30:
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*(pt.task for pt in c.primetime if pt.task))
+    return rest, g, ready, c.first_ping_at
+
+def bench_primetime(sizes: Tuple[int, ...] = (10, 1_000, 10_000)):
+    logging.getLogger("bot").setLevel(logging.WARNING)
+    async def run():
+        for n in sizes:
+            for manage in (True, False):
+                rest, g, ping_ms, wall = await ping_scenario(n, manage)
+                left = len(g.roles[bot.ROLE_PREMKA300].members)
+                mode = "clear_reaction" if manage else "per-user"
+                print(f"primetime ping n={n:>5} {mode:<14}: ping {ping_ms:6.1f} ms | całość {wall:6.2f} s | API {rest.total} (429: {rest.limited}) | zostało ról {left} | {_calls(rest)}")
+        for n in sizes:
+            rest, g, wall = await sync_scenario(n)
+            print(f"primetime sync n={n:>5}: {wall:6.2f} s | API {rest.total} (429: {rest.limited}) | {_calls(rest)}")
+        burst = 500
+        rest, g, wall = await burst_scenario(1_000, burst)
+        print(f"primetime burst {burst} wiad., n={1_000:>5}: {wall:6.2f} s | pingów {len(g.channels[bot.EM_CHANNEL_ID].sent)} | API {rest.total} | {_calls(rest)}")
+        for n in sizes:
+            rest, g, ready, first = await startup_scenario(n)
+            print(f"primetime start n={n:>5}: pierwszy ping {first*1000:6.1f} ms | on_ready {ready:6.2f} s | API {rest.total} | {_calls(rest)}")
+    asyncio.run(run())
+    try:
+        os.remove(STATE_PATH)
+    except OSError:
+        pass
+
+BENCHES: Dict[str, Callable[[], None]] = {"ruby": bench_ruby, "levels": bench_levels, "berimond": bench_berimond, "primetime": bench_primetime, "classify": bench_classify}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or list(BENCHES):
+        BENCHES[name]()
@@ -1,8 +1,15 @@
 from __future__ import annotations
-import os, re, math, logging, asyncio
-from typing import Dict, List, Tuple, Optional, Set
+import os, io, re, csv, sys, json, math, heapq, hashlib, time, sqlite3, logging, asyncio
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple, Optional, Set
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+import aiohttp
 import discord
 from discord import app_commands
 
@@ -37,7 +44,38 @@ MAIN_GUILD_ID = 1016796563227541574
 EM_CHANNEL_ID = 1414146583666364447
 SIGNUP_CHANNEL_ID = 1415624731293646891
 SIGNUP_MESSAGE_ID_ENV = int(os.getenv("SIGNUP_MESSAGE_ID") or 0)
+CLEANUP_WORKERS = max(1, int(os.getenv("CLEANUP_WORKERS") or 5))
+CLEANUP_CLEAR_EMOJI = (os.getenv("CLEANUP_CLEAR_EMOJI") or "1").strip().lower() not in ("0","n","no","false","nie")
 SELF_BOT_ID = 1413952299989995720
+STATE_DB = os.getenv("STATE_DB") or "bot_state.sqlite3"
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY") or 2.0)
+STATE_MAX_AGE = float(os.getenv("STATE_MAX_AGE") or 300)
+FORCE_COMMAND_SYNC = (os.getenv("FORCE_COMMAND_SYNC") or "").strip().lower() in ("1","y","yes","true","tak")
+SESSION_CACHE = max(1, int(os.getenv("SESSION_CACHE") or 512))
+RENDER_CACHE = max(1, int(os.getenv("RENDER_CACHE") or 1024))
+OWNER_ID = int(os.getenv("OWNER_ID") or os.getenv("OWNERR_ID") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+REACTION_DEBOUNCE = float(os.getenv("REACTION_DEBOUNCE") or 1.0)
+EM_PATTERNS = os.getenv("EM_PATTERNS") or ""
+PRIMETIME_CONFIG = os.getenv("PRIMETIME_CONFIG") or ""
+PRIMETIME_WEBHOOKS: List[str] = [u for u in re.split(r"[,\s;]+", os.getenv("PRIMETIME_WEBHOOKS") or "") if u]
+WEBHOOK_RETRIES = max(0, int(os.getenv("WEBHOOK_RETRIES") or 3))
+WEBHOOK_BACKOFF = float(os.getenv("WEBHOOK_BACKOFF") or 1.0)
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT") or 10)
+AUTO_SHARD = (os.getenv("AUTO_SHARD") or "").strip().lower() in ("1","y","yes","true","tak")
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL") or 300)
+MEMBER_CACHE_MAX = 2048
+MEMBER_BATCH_DELAY = 0.05
+MEMBER_LOOKUP_TIMEOUT = float(os.getenv("MEMBER_LOOKUP_TIMEOUT") or 15)
+EM_LOOKBACK = timedelta(minutes=12)
+EM_LOOKBACK_CATCHUP = timedelta(minutes=30)
+# klucz dedupe musi żyć co najmniej tak długo, jak długo wiadomość może jeszcze zostać rozpatrzona
+ANNOUNCED_TTL = max(EM_LOOKBACK, EM_LOOKBACK_CATCHUP)
+ANNOUNCED_MAX = 256
+PING_COOLDOWN = timedelta(minutes=30)
+CATCHUP_WINDOW = timedelta(minutes=30)
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL") or 600)
 
 ROLE_PREMKA300 = 1415630918529454081
 ROLE_PREMKAZWK = 1415631072246628433
@@ -81,71 +119,882 @@ intents.guilds = True
 intents.reactions = True
 intents.emojis = True
 
-class MyClient(discord.Client):
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
     def __init__(self):
-        super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
-        self.signup_message_id: Optional[int] = None
-        self.pending: Dict[int, Set[int]] = {ROLE_PREMKA300:set(), ROLE_PREMKAZWK:set(), ROLE_PREMKAHORY:set()}
-        self.announced: Set[Tuple[int, int]] = set()
-        self.last_ping: Dict[int, datetime] = {}
-        self.pt_task: Optional[asyncio.Task] = None
-        self.start_time: datetime = datetime.now(timezone.utc)
+        self.hist: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+        self.maxes: Dict[str, float] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, name: str, seconds: float):
+        h = self.hist.get(name)
+        if h is None:
+            h = self.hist[name] = [0] * len(self.BUCKETS)
+        h[bisect_left(self.BUCKETS, seconds)] += 1
+        self.sums[name] = self.sums.get(name, 0.0) + seconds
+        self.maxes[name] = max(self.maxes.get(name, 0.0), seconds)
+
+    def inc(self, name: str, label: str = "", n: int = 1):
+        c = self.counters.setdefault(name, {})
+        c[label] = c.get(label, 0) + n
+
+    def swallowed(self):
+        f = sys._getframe(1)
+        site = f"{getattr(f.f_code, 'co_qualname', f.f_code.co_name)}+{f.f_lineno - f.f_code.co_firstlineno}"
+        self.inc("swallowed_exceptions", site)
+        log.debug(f"Połknięty wyjątek w {site}", exc_info=True)
+
+    def timed(self, name: str):
+        def deco(fn):
+            @wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - t0)
+            return wrapper
+        return deco
+
+    def quantile(self, name: str, q: float) -> float:
+        h = self.hist.get(name) or []
+        total = sum(h); seen = 0
+        for b, n in zip(self.BUCKETS, h):
+            seen += n
+            if total and seen >= q * total:
+                return min(b, self.maxes.get(name, b))
+        return 0.0
+
+    def prometheus(self) -> str:
+        lines: List[str] = []
+        for name, h in sorted(self.hist.items()):
+            metric = "bot_latency_seconds"
+            acc = 0
+            for b, n in zip(self.BUCKETS, h):
+                acc += n
+                le = "+Inf" if b == float("inf") else repr(b)
+                lines.append(f'{metric}_bucket{{op="{name}",le="{le}"}} {acc}')
+            lines.append(f'{metric}_sum{{op="{name}"}} {self.sums.get(name, 0.0)}')
+            lines.append(f'{metric}_count{{op="{name}"}} {acc}')
+        for name, c in sorted(self.counters.items()):
+            for label, n in sorted(c.items()):
+                lines.append(f'bot_{name}_total{{key="{label}"}} {n}')
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                lines.append(f"bot_{name} {float(fn())}")
+            except Exception:
+                pass
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> str:
+        lines: List[str] = []
+        for name, h in sorted(self.hist.items()):
+            n = sum(h)
+            lines.append(f"`{name}` n={n} śr={self.sums[name]/n*1000:.0f}ms p50≤{self.quantile(name, .5)*1000:.0f}ms p95≤{self.quantile(name, .95)*1000:.0f}ms max={self.maxes[name]*1000:.0f}ms")
+        for name, c in sorted(self.counters.items()):
+            top = sorted(c.items(), key=lambda kv: -kv[1])[:5]
+            lines.append(f"`{name}` Σ={sum(c.values())}: " + ", ".join(f"{k or '-'}={v}" for k, v in top))
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                lines.append(f"`{name}` = {fn():g}")
+            except Exception:
+                pass
+        return "\n".join(lines) or "Brak danych."
 
-    async def setup_hook(self):
-        try:
-            self.tree.clear_commands(guild=None)
-            await self.tree.sync()
-        except Exception:
-            pass
-        if not GUILD_IDS:
-            for cmd in ALL_CMDS:
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                req = await asyncio.wait_for(reader.readline(), 5)
+                while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                    pass
+                ok = req.split(b" ")[1:2] == [b"/metrics"]
+                body = (self.prometheus() if ok else "not found\n").encode()
+                status = "200 OK" if ok else "404 Not Found"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except Exception:
+                pass
+            finally:
+                writer.close()
+        return await asyncio.start_server(handle, host, port)
+
+class _RateLimitCounter(logging.Handler):
+    def emit(self, record: logging.LogRecord):
+        if "rate limit" in record.getMessage().lower():
+            METRICS.inc("rate_limit_hits", record.name)
+
+METRICS = Metrics()
+logging.getLogger("discord.http").addHandler(_RateLimitCounter(logging.WARNING))
+
+async def _bounded(jobs, limit: int):
+    sem = asyncio.Semaphore(max(1, limit))
+    async def run(job):
+        async with sem:
+            return await job
+    return await asyncio.gather(*(run(j) for j in jobs), return_exceptions=True)
+
+class TTLDedupe:
+    def __init__(self, ttl: timedelta, maxlen: int):
+        self.ttl_ms = ttl.total_seconds() * 1000
+        self.maxlen = maxlen
+        self._d: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+
+    @staticmethod
+    def _ts_ms(key: Tuple[int, int]) -> int:
+        return (key[1] >> 22) + discord.utils.DISCORD_EPOCH
+
+    def _evict(self):
+        now_ms = time.time() * 1000
+        while self._d:
+            key, ts = next(iter(self._d.items()))
+            if len(self._d) <= self.maxlen and now_ms - ts < self.ttl_ms:
+                break
+            self._d.popitem(last=False)
+
+    def add(self, key: Tuple[int, int]):
+        self._d[key] = self._ts_ms(key)
+        self._evict()
+
+    def prune(self):
+        self._evict()
+
+    def update(self, keys: Iterable[Tuple[int, int]]):
+        for key in keys:
+            self._d[key] = self._ts_ms(key)
+        self._evict()
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        self._evict()
+        return key in self._d
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(list(self._d))
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+class MemberResolver:
+    def __init__(self, ttl: float, maxlen: int, delay: float, timeout: float):
+        self.ttl = ttl
+        self.maxlen = maxlen
+        self.delay = delay
+        self.timeout = timeout
+        self._cache: "OrderedDict[Tuple[int, int], Tuple[float, discord.Member]]" = OrderedDict()
+        self._waiting: Dict[int, Dict[int, asyncio.Future]] = {}
+        self._batches: Dict[int, asyncio.Task] = {}
+
+    async def get(self, guild: discord.Guild, user_id: int) -> discord.Member:
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        hit = self._cache.get((guild.id, user_id))
+        if hit and time.monotonic() - hit[0] < self.ttl:
+            return hit[1]
+        waiting = self._waiting.setdefault(guild.id, {})
+        fut = waiting.get(user_id)
+        if fut is None:
+            fut = waiting[user_id] = asyncio.get_running_loop().create_future()
+            task = self._batches.get(guild.id)
+            if task is None or task.done():
+                self._batches[guild.id] = asyncio.create_task(self._resolve(guild))
+        return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+
+    async def _resolve(self, guild: discord.Guild):
+        # zapytania, które przyszły w trakcie obsługi partii, trafiają do nowej listy oczekujących —
+        # kręcimy się, aż będzie pusta, bo get() nie startuje drugiego zadania, dopóki to żyje
+        while self._waiting.get(guild.id):
+            await asyncio.sleep(self.delay)
+            await self._resolve_batch(guild, self._waiting.pop(guild.id, {}))
+
+    async def _resolve_batch(self, guild: discord.Guild, batch: Dict[int, asyncio.Future]):
+        ids = list(batch)
+        found: Dict[int, discord.Member] = {}
+        for k in range(0, len(ids), 100):
+            try:
+                for m in await guild.query_members(user_ids=ids[k:k+100], cache=True):
+                    found[m.id] = m
+            except Exception:
+                METRICS.swallowed()
+        for uid, fut in batch.items():
+            member = found.get(uid)
+            if member is None:
                 try:
-                    self.tree.add_command(cmd)
-                except Exception:
+                    member = await guild.fetch_member(uid)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                    continue
+            self._remember(guild.id, member)
+            if not fut.done():
+                fut.set_result(member)
+
+    def _remember(self, guild_id: int, member: discord.Member):
+        self._cache[(guild_id, member.id)] = (time.monotonic(), member)
+        self._cache.move_to_end((guild_id, member.id))
+        while len(self._cache) > self.maxlen:
+            self._cache.popitem(last=False)
+
+    def prune(self):
+        now = time.monotonic()
+        for key in [k for k, (ts, _) in self._cache.items() if now - ts >= self.ttl]:
+            del self._cache[key]
+
+class ReactionPipeline:
+    def __init__(self, apply: Callable[[int, int, int, bool], "asyncio.Future"], window: float, workers: int):
+        self.apply = apply
+        self.window = window
+        self.workers = workers
+        # wartość: (czy rola ma być, numer zdarzenia) — numer pozwala odróżnić wpis sprzed migawki od nowszego
+        self.desired: Dict[Tuple[int, int, int], Tuple[bool, int]] = {}
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def push(self, guild_id: int, user_id: int, role_id: int, want: bool):
+        key = (guild_id, user_id, role_id)
+        METRICS.inc("reaction_events", "coalesced" if key in self.desired else "queued")
+        self._seq += 1
+        self.desired[key] = (want, self._seq)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+
+    def snapshot_role(self, role_id: int) -> Dict[Tuple[int, int, int], Tuple[bool, int]]:
+        return {k: v for k, v in self.desired.items() if k[2] == role_id}
+
+    def forget(self, snapshot: Dict[Tuple[int, int, int], Tuple[bool, int]]):
+        # zdarzenia, które przyszły po migawce (np. reakcja dodana już po clear_reaction), zostają w kolejce
+        for key, entry in snapshot.items():
+            if self.desired.get(key) == entry:
+                del self.desired[key]
+
+    async def _drain(self):
+        while self.desired:
+            await asyncio.sleep(self.window)
+            batch, self.desired = self.desired, {}
+            await _bounded([self.apply(g, u, r, want) for (g, u, r), (want, _) in batch.items()], self.workers)
+
+class Scheduler:
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, Tuple[float, int, Callable[[], object]]] = {}
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def at(self, key: str, when: datetime, fn: Callable[[], object]):
+        self.after(key, (when - datetime.now(timezone.utc)).total_seconds(), fn)
+
+    def after(self, key: str, delay: float, fn: Callable[[], object]):
+        # ponowne zgłoszenie tego samego klucza przesuwa termin; stary wpis w kopcu zostaje jako martwy
+        self._seq += 1
+        due = time.monotonic() + max(0.0, delay)
+        self._jobs[key] = (due, self._seq, fn)
+        heapq.heappush(self._heap, (due, self._seq, key))
+        if self._heap[0][1] == self._seq:
+            self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key: str):
+        self._jobs.pop(key, None)
+
+    def pending(self) -> List[Tuple[str, float]]:
+        now = time.monotonic()
+        return sorted(((k, due - now) for k, (due, _, _) in self._jobs.items()), key=lambda kv: kv[1])
+
+    async def _run(self):
+        while self._jobs:
+            due, seq, key = self._heap[0]
+            job = self._jobs.get(key)
+            if job is None or job[1] != seq:
+                heapq.heappop(self._heap)
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
                     pass
-            await self.tree.sync()
-        else:
-            for gid in GUILD_IDS:
-                gobj = discord.Object(id=gid)
-                for cmd in ALL_CMDS:
-                    try:
-                        self.tree.add_command(cmd, guild=gobj)
-                    except Exception:
-                        pass
+                continue
+            heapq.heappop(self._heap)
+            del self._jobs[key]
+            METRICS.inc("scheduler_fired", key.split(":", 1)[0])
+            try:
+                res = job[2]()
+                if asyncio.iscoroutine(res):
+                    await res
+            except Exception:
+                METRICS.swallowed()
+        self._heap.clear()
+
+class Broadcaster:
+    def __init__(self, retries: int, backoff: float, timeout: float):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    @property
+    def budget(self) -> float:
+        # najdłuższa możliwa wysyłka bez 429: wszystkie próby po timeout plus przerwy między nimi
+        return (self.retries + 1) * self.timeout + sum(self.backoff * 2 ** k for k in range(self.retries))
+
+    @staticmethod
+    def _label(url: str) -> str:
+        # w URL jest token webhooka — do logów i metryk idzie tylko jego ID
+        parts = url.rstrip("/").split("/")
+        return parts[-2] if len(parts) >= 2 else "?"
+
+    def fanout(self, urls: Iterable[str], content: str):
+        if len(content) > 2000:
+            content = content[:1999] + "…"
+        for url in urls:
+            task = asyncio.create_task(self._send(url, content))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _post(self, url: str, payload: Dict[str, object]) -> Tuple[int, float]:
+        async with self._session().post(url, json=payload) as resp:
+            return resp.status, float(resp.headers.get("Retry-After") or 0)
+
+    async def _send(self, url: str, content: str):
+        # wprost do REST, bez discord.Webhook: jego adapter ma własne ponowienia (429/5xx/OSError),
+        # a tu ma być jedna warstwa ponowień i każda próba ograniczona przez timeout
+        label = self._label(url)
+        payload = {"content": content, "username": "PrimeTime", "allowed_mentions": {"parse": []}}
+        t0 = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                status, retry_after = await asyncio.wait_for(self._post(url, payload), self.timeout)
+            except aiohttp.InvalidURL as e:
+                log.warning(f"Webhook {label}: zły URL ({e}) — pomijam cel")
+                METRICS.inc("webhook_sends", "dead")
+                return
+            except (asyncio.TimeoutError, aiohttp.ClientError, OSError):
+                METRICS.swallowed()
+                status = 0
+            else:
+                if status < 300:
+                    METRICS.inc("webhook_sends", "ok")
+                    METRICS.observe("webhook_delivery", time.perf_counter() - t0)
+                    return
+                if status == 429:
+                    delay = max(delay, retry_after)
+                elif 400 <= status < 500:
+                    # zły token, usunięty webhook, zła treść — ponowienie nic nie zmieni
+                    log.warning(f"Webhook {label}: HTTP {status} — pomijam cel")
+                    METRICS.inc("webhook_sends", "dead")
+                    return
+            METRICS.inc("webhook_sends", "retry" if attempt < self.retries else "failed")
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+        log.warning(f"Webhook {label}: nie doręczono po {self.retries + 1} próbach (ostatnio {f'HTTP {status}' if status else 'brak odpowiedzi'})")
+
+    async def close(self):
+        if self._tasks:
+            _, left = await asyncio.wait(list(self._tasks), timeout=self.budget + 1)
+            if left:
+                log.warning(f"Webhook: przerywam {len(left)} wysyłek przy zamykaniu")
+                for task in left:
+                    task.cancel()
+                await asyncio.gather(*left, return_exceptions=True)
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+class EmMatcher:
+    def __init__(self, patterns: Iterable[Tuple[str, Iterable[str]]]):
+        self.kinds: List[str] = []
+        self._lits: List[Tuple[str, int]] = []
+        groups: List[str] = []
+        for kind, texts in patterns:
+            texts = [t for t in texts if t]
+            if texts:
+                self.kinds.append(kind)
+                self._lits += [(t, len(self.kinds)) for t in texts]
+                groups.append("(" + "|".join(re.escape(t) for t in sorted(texts, key=len, reverse=True)) + ")")
+        self._re = re.compile("|".join(groups)) if groups else None
+        # Wszystkie wbudowane warianty zaczynają się od "A new EM: PT " — wtedy wystarczy
+        # str.find po wspólnym prefiksie i startswith w miejscu trafienia zamiast regexu.
+        self._prefix = os.path.commonprefix([t for t, _ in self._lits])
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, object]) -> "EmMatcher":
+        # klucze to emoji z wiadomości zapisów
+        return cls((k, [v] if isinstance(v, str) else v) for k, v in raw.items())
+
+    @classmethod
+    def load(cls, path: str) -> "EmMatcher":
+        default = [(EMOJI_300GL, MATCH_300GL), (EMOJI_200OR, MATCH_200OR), (EMOJI_200BTH, MATCH_200BTH)]
+        if not path:
+            return cls(default)
+        try:
+            with open(path, encoding="utf-8") as fh:
+                return cls.from_dict(json.load(fh))
+        except Exception as e:
+            log.warning(f"EM_PATTERNS {path}: {e} — używam wbudowanych wzorców")
+            return cls(default)
+
+    def _best(self, text: str, best: int) -> int:
+        if len(self._prefix) >= 4:
+            i = text.find(self._prefix)
+            while i >= 0:
+                for t, idx in self._lits:
+                    if idx < best and text.startswith(t, i):
+                        best = idx
+                if best == 1:
+                    break
+                i = text.find(self._prefix, i + 1)
+            return best
+        for m in self._re.finditer(text):
+            best = min(best, m.lastindex)
+            if best == 1:
+                break
+        return best
+
+    def match(self, msg: discord.Message) -> Optional[str]:
+        if self._re is None:
+            return None
+        best = self._best(msg.content, len(self.kinds) + 1) if msg.content else len(self.kinds) + 1
+        if best > 1 and msg.embeds:
+            parts: List[str] = []
+            for e in msg.embeds:
                 try:
-                    await self.tree.sync(guild=gobj)
+                    parts += (e.title or "", e.description or "", getattr(e.footer, "text", None) or "", getattr(e.author, "name", None) or "")
+                    for f in (e.fields or []):
+                        parts += (f.name or "", f.value or "")
                 except Exception:
-                    pass
+                    METRICS.swallowed()
+            best = self._best("\n".join(parts), best)
+        return self.kinds[best - 1] if best <= len(self.kinds) else None
+
+EM_MATCHER = EmMatcher.load(EM_PATTERNS)
+
+class PrimeTimeGuild:
+    def __init__(self, guild_id: int, em_channel_id: int, signup_channel_id: int, roles: Dict[str, int],
+                 signup_message_id: int = 0, matcher: Optional[EmMatcher] = None, signup_text: str = SIGNUP_TEXT,
+                 webhooks: Sequence[str] = ()):
+        self.guild_id = guild_id
+        self.em_channel_id = em_channel_id
+        self.signup_channel_id = signup_channel_id
+        self.roles = roles
+        self.emoji_for = {r: e for e, r in roles.items()}
+        self.signup_message_id_env = signup_message_id
+        self.signup_text = signup_text
+        self.webhooks = list(webhooks)
+        self.matcher = matcher or EM_MATCHER
+        self.signup_message_id: Optional[int] = None
+        self.pending: Dict[int, Set[int]] = {rid: set() for rid in roles.values()}
+        self.last_ping: Dict[int, datetime] = {}
+        self.deferred: Set[int] = set()
+        self.cleaning: Set[int] = set()
+        self.announced = TTLDedupe(ANNOUNCED_TTL, ANNOUNCED_MAX)
+        self.ping_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, object]) -> "PrimeTimeGuild":
+        patterns = raw.get("patterns")
+        roles = {str(e): int(r) for e, r in raw["roles"].items()}
+        matcher = EmMatcher.from_dict(patterns) if patterns else EM_MATCHER
+        unknown = set(matcher.kinds) - set(roles)
+        if unknown:
+            # bez tego EM pasujące do takiego wzorca byłyby po cichu pomijane
+            raise ValueError(f"serwer {raw['guild_id']}: wzorce bez roli: {', '.join(sorted(unknown))}")
+        return cls(int(raw["guild_id"]), int(raw["em_channel_id"]), int(raw["signup_channel_id"]),
+                   roles, int(raw.get("signup_message_id") or 0), matcher,
+                   str(raw.get("signup_text") or SIGNUP_TEXT), [str(u) for u in raw.get("webhooks") or []])
+
+    def classify(self, msg: discord.Message) -> Optional[int]:
+        kind = self.matcher.match(msg)
+        return self.roles.get(kind) if kind else None
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "signup_message_id": self.signup_message_id,
+            "pending": {str(r): sorted(u) for r, u in self.pending.items()},
+            "last_ping": {str(r): t.isoformat() for r, t in self.last_ping.items()},
+            "announced": [[r, m] for r, m in self.announced],
+        }
+
+    def restore(self, data: Dict[str, object]):
+        self.signup_message_id = int(data.get("signup_message_id") or 0) or None
+        for r, users in (data.get("pending") or {}).items():
+            self.pending.setdefault(int(r), set()).update(int(u) for u in users)
+        for r, ts in (data.get("last_ping") or {}).items():
+            self.last_ping[int(r)] = datetime.fromisoformat(ts)
+        self.announced.update((int(r), int(m)) for r, m in (data.get("announced") or []))
+
+class PrimeTimeIndex:
+    def __init__(self, guilds: Iterable[PrimeTimeGuild]):
+        self.by_guild: Dict[int, PrimeTimeGuild] = {pt.guild_id: pt for pt in guilds}
+        self.by_channel: Dict[int, PrimeTimeGuild] = {pt.em_channel_id: pt for pt in self.by_guild.values()}
+        self.by_message: Dict[int, PrimeTimeGuild] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "PrimeTimeIndex":
+        if not path:
+            return cls([PrimeTimeGuild(MAIN_GUILD_ID, EM_CHANNEL_ID, SIGNUP_CHANNEL_ID, dict(EMOJI_TO_ROLE), SIGNUP_MESSAGE_ID_ENV,
+                                       webhooks=PRIMETIME_WEBHOOKS)])
+        try:
+            with open(path, encoding="utf-8") as fh:
+                return cls(PrimeTimeGuild.from_dict(g) for g in json.load(fh))
+        except Exception as e:
+            raise RuntimeError(f"Błędny PRIMETIME_CONFIG {path}: {e}") from e
+
+    def __iter__(self) -> Iterator[PrimeTimeGuild]:
+        return iter(list(self.by_guild.values()))
+
+    def __len__(self) -> int:
+        return len(self.by_guild)
+
+    def bind(self, pt: PrimeTimeGuild, message_id: Optional[int]):
+        if pt.signup_message_id and self.by_message.get(pt.signup_message_id) is pt:
+            del self.by_message[pt.signup_message_id]
+        pt.signup_message_id = message_id
+        if message_id:
+            self.by_message[message_id] = pt
+
+    def snapshot(self) -> Dict[str, object]:
+        return {f"primetime:{pt.guild_id}": pt.snapshot() for pt in self.by_guild.values()}
+
+    def restore(self, data: Dict[str, object]):
+        for pt in self.by_guild.values():
+            part = data.get(f"primetime:{pt.guild_id}")
+            if isinstance(part, dict):
+                pt.restore(part)
+                self.bind(pt, pt.signup_message_id)
+
+def _is_text_channel(ch) -> bool:
+    # po typie, nie po klasie: tak samo traktujemy kanał z cache, z fetch_channel i atrapę z bench.py
+    return getattr(ch, "type", None) in (discord.ChannelType.text, discord.ChannelType.news)
+
+_DB_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+class SessionStore:
+    def __init__(self, kind: str, defaults: Dict[str, int], path: str, capacity: int):
+        self.kind = kind
+        self.defaults = defaults
+        self.path = path
+        self.capacity = capacity
+        self._lru: "OrderedDict[int, dict]" = OrderedDict()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path)
+        con.execute("CREATE TABLE IF NOT EXISTS sessions (kind TEXT NOT NULL, uid INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, uid))")
+        return con
+
+    def _read(self, uid: int) -> Optional[dict]:
+        with closing(self._connect()) as con:
+            row = con.execute("SELECT data FROM sessions WHERE kind = ? AND uid = ?", (self.kind, uid)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, uid: int, data: dict):
+        with closing(self._connect()) as con, con:
+            con.execute("INSERT OR REPLACE INTO sessions (kind, uid, data) VALUES (?, ?, ?)", (self.kind, uid, json.dumps(data)))
+
+    def _remember(self, uid: int, data: dict) -> dict:
+        self._lru[uid] = data
+        self._lru.move_to_end(uid)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+        return data
+
+    async def get(self, uid: int) -> dict:
+        if uid in self._lru:
+            self._lru.move_to_end(uid)
+            return self._lru[uid]
+        data: Optional[dict] = None
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(_DB_POOL, self._read, uid)
+        except Exception:
+            METRICS.swallowed()
+            data = None
+        return self._remember(uid, {**self.defaults, **(data or {})})
+
+    async def save(self, uid: int, data: dict):
+        self._remember(uid, data)
+        try:
+            await asyncio.get_running_loop().run_in_executor(_DB_POOL, self._write, uid, dict(data))
+        except Exception:
+            METRICS.swallowed()
+
+    async def reset(self, uid: int) -> dict:
+        data = dict(self.defaults)
+        await self.save(uid, data)
+        return data
+
+class StateStore:
+    def __init__(self, path: str, snapshot: Callable[[], Dict[str, object]]):
+        self.path = path
+        self.snapshot = snapshot
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path)
+        con.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return con
+
+    def load(self) -> Dict[str, object]:
+        out: Dict[str, object] = {}
+        try:
+            with closing(self._connect()) as con:
+                rows = con.execute("SELECT key, value FROM kv").fetchall()
+        except Exception:
+            METRICS.swallowed()
+            return out
+        for k, v in rows:
+            try:
+                out[k] = json.loads(v)
+            except Exception:
+                METRICS.swallowed()
+        return out
+
+    def _write(self, data: Dict[str, object]):
+        with closing(self._connect()) as con, con:
+            con.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", [(k, json.dumps(v)) for k, v in data.items()])
+
+    def touch(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self):
+        while self._dirty:
+            await asyncio.sleep(STATE_FLUSH_DELAY)
+            await self.flush()
+
+    async def put(self, key: str, value: object):
+        try:
+            await asyncio.get_running_loop().run_in_executor(_DB_POOL, self._write, {key: value})
+        except Exception:
+            METRICS.swallowed()
+
+    async def flush(self):
+        self._dirty = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(_DB_POOL, self._write, self.snapshot())
+        except Exception:
+            METRICS.swallowed()
+
+class MyClient(discord.AutoShardedClient if AUTO_SHARD else discord.Client):
+    def __init__(self):
+        super().__init__(intents=intents, chunk_guilds_at_startup=True)
+        self.tree = app_commands.CommandTree(self)
+        self.primetime = PrimeTimeIndex.load(PRIMETIME_CONFIG)
+        self.start_time: datetime = datetime.now(timezone.utc)
+        self.catchup = True
+        self.scheduler = Scheduler()
+        self.stages_done: Set[str] = set()
+        self.stages_running: Dict[str, asyncio.Task] = {}
+        self.background: Set[asyncio.Task] = set()
+        self.owner_ids: Optional[Set[int]] = None
+        self.first_ping_at: Optional[float] = None
+        self.broadcaster = Broadcaster(WEBHOOK_RETRIES, WEBHOOK_BACKOFF, WEBHOOK_TIMEOUT)
+        self.state = StateStore(STATE_DB, self._state_snapshot)
+        self.state_fresh = False
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        self.handles: Dict[int, discord.TextChannel] = {}
+        self.reaction_pipeline = ReactionPipeline(self._apply_signup, REACTION_DEBOUNCE, CLEANUP_WORKERS)
+        self.member_resolver = MemberResolver(MEMBER_CACHE_TTL, MEMBER_CACHE_MAX, MEMBER_BATCH_DELAY, MEMBER_LOOKUP_TIMEOUT)
+        METRICS.gauges["primetime_guilds"] = lambda: len(self.primetime)
+        METRICS.gauges["announced_dedupe_size"] = lambda: sum(len(pt.announced) for pt in self.primetime)
+        METRICS.gauges["pending_signups"] = lambda: sum(len(u) for pt in self.primetime for u in pt.pending.values())
+        METRICS.gauges["scheduler_pending"] = lambda: len(self.scheduler.pending())
+        METRICS.gauges["webhook_in_flight"] = lambda: len(self.broadcaster._tasks)
+
+    def _state_snapshot(self) -> Dict[str, object]:
+        return {"saved_at": datetime.now(timezone.utc).isoformat(), **self.primetime.snapshot()}
+
+    def _state_restore(self, data: Dict[str, object]):
+        try:
+            self.primetime.restore(data)
+            if data.get("saved_at"):
+                saved_at = datetime.fromisoformat(data["saved_at"])
+                self.state_fresh = (datetime.now(timezone.utc) - saved_at) < timedelta(seconds=STATE_MAX_AGE)
+        except Exception:
+            METRICS.swallowed()
+
+    async def close(self):
+        await self.state.flush()
+        await self.broadcaster.close()
+        await super().close()
+
+    def _instrument_http(self):
+        request = self.http.request
+        @wraps(request)
+        async def counted(route, **kwargs):
+            METRICS.inc("rest_calls", f"{route.method} {route.path}")
+            return await request(route, **kwargs)
+        self.http.request = counted  # type: ignore
+
+    async def setup_hook(self):
+        self._instrument_http()
+        self.add_dynamic_items(PanelButton)
+        if METRICS_PORT:
+            try:
+                self.metrics_server = await METRICS.serve(METRICS_HOST, METRICS_PORT)
+                log.info(f"Metryki Prometheus na http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+            except Exception:
+                METRICS.swallowed()
+        t0 = time.perf_counter()
+        data = await asyncio.get_running_loop().run_in_executor(_DB_POOL, self.state.load)
+        self._state_restore(data)
+        log.info(f"Stan wczytany w {(time.perf_counter()-t0)*1000:.1f} ms (świeży: {self.state_fresh})")
+        self.scheduler.at("catchup:end", self.start_time + CATCHUP_WINDOW, self._end_catchup)
+        self.scheduler.after("maintenance", MAINTENANCE_INTERVAL, self._maintenance)
+        for pt in self.primetime:
+            for role_id, last in pt.last_ping.items():
+                self._arm_cooldown(pt, role_id, last)
+        await self.sync_commands(data.get("command_hashes") or {})
+
+    def _command_hash(self, guild: Optional[discord.Object]) -> str:
+        payload = sorted((c.to_dict(self.tree) for c in self.tree.get_commands(guild=guild)), key=lambda d: d["name"])
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    async def sync_commands(self, known: Dict[str, str]):
+        guilds = [discord.Object(id=gid) for gid in GUILD_IDS]
+        for cmd in ALL_CMDS:
+            for gobj in (guilds or [None]):
                 try:
-                    await self.tree.fetch_commands(guild=gobj)
+                    self.tree.add_command(cmd, guild=gobj)
                 except Exception:
-                    pass
+                    METRICS.swallowed()
+        scopes: Dict[str, Optional[discord.Object]] = {"global": None, **{str(g.id): g for g in guilds}}
+        hashes = {key: self._command_hash(gobj) for key, gobj in scopes.items()}
+        stale = [key for key in scopes if FORCE_COMMAND_SYNC or known.get(key) != hashes[key]]
+
+        async def sync(key: str) -> Optional[str]:
+            try:
+                await self.tree.sync(guild=scopes[key])
+                return key
+            except Exception:
+                METRICS.swallowed()
+                return None
+
+        synced = [k for k in await asyncio.gather(*(sync(k) for k in stale)) if k]
+        await self.state.put("command_hashes", {k: h for k, h in hashes.items() if k in synced or known.get(k) == h})
+        log.info(f"Komendy: zsynchronizowano {len(synced)}/{len(scopes)} zakresów (bez zmian: {len(scopes)-len(stale)})")
 
     async def on_ready(self):
-        await self.change_presence(activity=None, status=discord.Status.online)
-        await load_hub_emoji(self)
-        await self.ensure_signup_message()
-        await self.sync_roles_from_reactions()
-        if self.pt_task is None:
-            self.pt_task = asyncio.create_task(self.primetime_loop())
-        log.info(f"Gotowy jako {self.user} ({self.user.id})")
-
-    async def ensure_signup_message(self):
-        guild = self.get_guild(MAIN_GUILD_ID)
-        if not guild:
+        t0 = time.perf_counter()
+        # wykrywanie EM rusza pierwsze — reszta startu nie opóźnia pierwszego pingu
+        await self._stage("detection", self._start_detection, once=False)
+        await asyncio.gather(
+            self._stage("presence", lambda: self.change_presence(activity=None, status=discord.Status.online), once=False),
+            self._stage("chunk", self._start_chunking, once=False),
+            self._stage("emoji", lambda: load_hub_emoji(self)),
+            _bounded([self._bootstrap_guild(pt) for pt in self.primetime], CLEANUP_WORKERS),
+        )
+        log.info(f"Gotowy jako {self.user} ({self.user.id}), serwery PrimeTime: {len(self.primetime)}, start {time.perf_counter()-t0:.2f}s")
+
+    async def _stage(self, name: str, fn: Callable[[], Awaitable[object]], once: bool = True):
+        # etapy "once" po udanym przebiegu nie wracają przy kolejnym on_ready (reconnect);
+        # etap, który jeszcze trwa, jest współdzielony zamiast uruchamiany drugi raz
+        if once and name in self.stages_done:
             return
-        ch: Optional[discord.TextChannel] = guild.get_channel(SIGNUP_CHANNEL_ID)  # type: ignore
-        if not isinstance(ch, discord.TextChannel):
+        task = self.stages_running.get(name)
+        if task is None or task.done():
+            task = self.stages_running[name] = asyncio.create_task(self._run_stage(name, fn))
+        await asyncio.shield(task)
+
+    async def _run_stage(self, name: str, fn: Callable[[], Awaitable[object]]):
+        t0 = time.perf_counter()
+        try:
+            await fn()
+            self.stages_done.add(name)
+        except Exception:
+            METRICS.swallowed()
+        METRICS.observe(f"bootstrap:{name.split(':', 1)[0]}", time.perf_counter() - t0)
+        self.stages_running.pop(name, None)
+
+    async def is_app_owner(self, user: discord.abc.User) -> bool:
+        # discord.Client nie ma is_owner (to metoda commands.Bot) — właściciela bierzemy z application_info
+        if user.id == OWNER_ID:
+            return True
+        if self.owner_ids is None:
+            info = await self.application_info()
+            self.owner_ids = {m.id for m in info.team.members} if info.team else {info.owner.id}
+        return user.id in self.owner_ids
+
+    def _spawn(self, coro: Awaitable[object]) -> asyncio.Task:
+        # pętla trzyma tylko słabe referencje do zadań — bez tego zbioru GC może je ubić w trakcie
+        task = asyncio.ensure_future(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def _start_detection(self):
+        self._schedule_catchup()
+
+    async def _start_chunking(self):
+        for pt in self.primetime:
+            guild = self.get_guild(pt.guild_id)
+            if guild and not guild.chunked:
+                self._spawn(guild.chunk())
+
+    async def _bootstrap_guild(self, pt: PrimeTimeGuild):
+        await self._stage(f"signup:{pt.guild_id}", lambda: self.ensure_signup_message(pt))
+        # ani restart, ani ponowne IDENTIFY nie odtwarzają zdarzeń z przerwy — sync (diff) robimy przy każdym on_ready
+        await self._stage(f"sync:{pt.guild_id}", lambda: self.sync_roles_from_reactions(pt), once=False)
+
+    async def _text_channel(self, guild: discord.Guild, channel_id: int) -> Optional[discord.TextChannel]:
+        ch = self.handles.get(channel_id)
+        if ch is not None:
+            return ch
+        ch = guild.get_channel(channel_id)  # type: ignore
+        if not _is_text_channel(ch):
             try:
-                ch = await self.fetch_channel(SIGNUP_CHANNEL_ID)  # type: ignore
+                ch = await self.fetch_channel(channel_id)  # type: ignore
             except Exception:
-                return
+                METRICS.swallowed()
+                return None
+        if not _is_text_channel(ch):
+            return None
+        self.handles[channel_id] = ch
+        return ch
+
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        if after.id in self.handles:
+            if _is_text_channel(after):
+                self.handles[after.id] = after
+            else:
+                self.handles.pop(after.id, None)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.handles.pop(channel.id, None)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        pt = self.primetime.by_message.get(payload.message_id)
+        if pt is not None:
+            self.primetime.bind(pt, None)
+            self.state.touch()
+            self._spawn(self.ensure_signup_message(pt))
+
+    async def ensure_signup_message(self, pt: PrimeTimeGuild):
+        guild = self.get_guild(pt.guild_id)
+        if not guild:
+            return
+        ch = await self._text_channel(guild, pt.signup_channel_id)
+        if ch is None:
+            return
         msg: Optional[discord.Message] = None
-        if SIGNUP_MESSAGE_ID_ENV:
+        for mid in dict.fromkeys(x for x in (pt.signup_message_id_env, pt.signup_message_id) if x):
             try:
-                msg = await ch.fetch_message(SIGNUP_MESSAGE_ID_ENV)
+                msg = await ch.fetch_message(mid)
+                break
             except Exception:
+                METRICS.swallowed()
                 msg = None
         if msg is None:
             try:
@@ -154,153 +1003,201 @@ class MyClient(discord.Client):
                         msg = m
                         break
             except Exception:
+                METRICS.swallowed()
                 msg = None
         if msg is None:
             try:
-                msg = await ch.send(SIGNUP_TEXT)
+                msg = await ch.send(pt.signup_text)
             except Exception:
+                METRICS.swallowed()
                 msg = None
         if msg:
-            self.signup_message_id = msg.id
-            await self._ensure_reactions(msg)
-
-    async def sync_roles_from_reactions(self):
-        guild = self.get_guild(MAIN_GUILD_ID)
-        if not guild or not self.signup_message_id:
+            self.primetime.bind(pt, msg.id)
+            self.state.touch()
+            await self._ensure_reactions(msg, list(pt.roles))
+
+    @METRICS.timed("sync_roles_from_reactions")
+    async def sync_roles_from_reactions(self, pt: PrimeTimeGuild):
+        guild = self.get_guild(pt.guild_id)
+        if not guild or not pt.signup_message_id:
+            return
+        started = datetime.now(timezone.utc)
+        ch = await self._text_channel(guild, pt.signup_channel_id)
+        if ch is None:
+            return
+        # zawsze świeży odczyt: discord.py nie aktualizuje reakcji w zbuforowanym Message (reakcje nie
+        # przychodzą jako MESSAGE_UPDATE), a brak emoji w starej kopii oznaczałby zdjęcie roli wszystkim
+        try:
+            msg = await ch.fetch_message(pt.signup_message_id)
+        except Exception:
+            METRICS.swallowed()
             return
-        ch: Optional[discord.TextChannel] = guild.get_channel(SIGNUP_CHANNEL_ID)  # type: ignore
-        if not isinstance(ch, discord.TextChannel):
+        wanted: Dict[int, Set[int]] = {rid: set() for rid in pt.roles.values()}
+        for reaction in msg.reactions:
+            role_id = pt.roles.get(str(reaction.emoji))
+            if not role_id:
+                continue
             try:
-                ch = await self.fetch_channel(SIGNUP_CHANNEL_ID)  # type: ignore
+                wanted[role_id] = {u.id async for u in reaction.users(limit=None) if not u.bot}
             except Exception:
-                return
+                METRICS.swallowed()
+                wanted.pop(role_id, None)
+
+        jobs = []
+        naive = 0
+        for role_id in pt.roles.values():
+            role = guild.get_role(role_id)
+            if not role or role_id not in wanted:
+                continue
+            if role_id in pt.cleaning or ((last := pt.last_ping.get(role_id)) and last >= started):
+                # ping w trakcie synchronizacji sprząta tę rolę sam; pobrane reakcje są nieaktualne
+                continue
+            want = wanted[role_id]
+            have = {m.id for m in role.members}
+            naive += len(have) + len(want)
+            pend = pt.pending.setdefault(role_id, set())
+            pend.clear()
+            pend.update(have & want)
+            for uid in want - have:
+                jobs.append(self._sync_add(pt, guild, uid, role_id))
+            for uid in have - want:
+                jobs.append(self._sync_remove(guild, uid, role_id))
+        await _bounded(jobs, CLEANUP_WORKERS)
+        self.state.touch()
+        log.info(f"Sync PrimeTime: {len(jobs)} wywołań API zamiast {naive} (oszczędzono {naive-len(jobs)})")
+
+    async def _sync_add(self, pt: PrimeTimeGuild, guild: discord.Guild, user_id: int, role_id: int):
         try:
-            for role_id in [ROLE_PREMKA300, ROLE_PREMKAZWK, ROLE_PREMKAHORY]:
-                role = guild.get_role(role_id)
-                if role:
-                    for m in list(role.members):
-                        try:
-                            await m.remove_roles(role, reason="PrimeTime reset przy starcie")
-                        except Exception:
-                            pass
-                    self.pending[role_id].clear()
-            msg = await ch.fetch_message(self.signup_message_id)
-            for reaction in msg.reactions:
-                emoji_str = str(reaction.emoji)
-                role_id = EMOJI_TO_ROLE.get(emoji_str)
-                if not role_id:
-                    continue
-                try:
-                    async for user in reaction.users(limit=None):
-                        if user.bot:
-                            continue
-                        try:
-                            member = guild.get_member(user.id) or await guild.fetch_member(user.id)
-                            role = guild.get_role(role_id)
-                            if role:
-                                await member.add_roles(role, reason="PrimeTime sync po starcie")
-                                self.pending.setdefault(role_id, set()).add(member.id)
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
+            await self.http.add_role(guild.id, user_id, role_id, reason="PrimeTime sync po starcie")
+            pt.pending.setdefault(role_id, set()).add(user_id)
         except Exception:
-            pass
+            METRICS.swallowed()
+
+    async def _sync_remove(self, guild: discord.Guild, user_id: int, role_id: int):
+        try:
+            await self.http.remove_role(guild.id, user_id, role_id, reason="PrimeTime sync po starcie")
+        except Exception:
+            METRICS.swallowed()
 
-    async def _ensure_reactions(self, msg: discord.Message):
-        order = [EMOJI_300GL, EMOJI_200OR, EMOJI_200BTH]
-        have = set(str(r.emoji) for r in msg.reactions)
+    async def _ensure_reactions(self, msg: discord.Message | discord.PartialMessage, order: Optional[List[str]] = None):
+        order = order or [EMOJI_300GL, EMOJI_200OR, EMOJI_200BTH]
+        have = set(str(r.emoji) for r in getattr(msg, "reactions", []))
         for em in order:
             if em not in have:
                 try:
                     await msg.add_reaction(em)
                 except Exception:
-                    pass
+                    METRICS.swallowed()
 
-    def _role_for_emoji(self, emoji_str: str) -> Optional[int]:
-        return EMOJI_TO_ROLE.get(emoji_str)
-
-    async def _add_pending_role(self, guild: discord.Guild, user_id: int, role_id: int):
+    @METRICS.timed("_add_pending_role")
+    async def _add_pending_role(self, pt: PrimeTimeGuild, guild: discord.Guild, user_id: int, role_id: int):
         role = guild.get_role(role_id)
         if not role:
             return
         try:
-            member = guild.get_member(user_id) or await guild.fetch_member(user_id)
-            await member.add_roles(role, reason="PrimeTime signup (one-shot)")
-            self.pending.setdefault(role_id, set()).add(user_id)
+            member = await self.member_resolver.get(guild, user_id)
+            if role not in member.roles:
+                await member.add_roles(role, reason="PrimeTime signup (one-shot)")
+            pt.pending.setdefault(role_id, set()).add(user_id)
+            self.state.touch()
         except Exception:
-            pass
+            METRICS.swallowed()
 
-    async def _remove_pending_role_and_reaction(self, guild: discord.Guild, user_id: int, role_id: int):
-        role = guild.get_role(role_id)
-        if role:
-            try:
-                member = guild.get_member(user_id) or await guild.fetch_member(user_id)
-                if role in member.roles:
-                    await member.remove_roles(role, reason="PrimeTime one-shot zakończony")
-            except Exception:
-                pass
-        if self.signup_message_id:
-            try:
-                ch = guild.get_channel(SIGNUP_CHANNEL_ID) or await self.fetch_channel(SIGNUP_CHANNEL_ID)  # type: ignore
-                if isinstance(ch, discord.TextChannel):
-                    msg = await ch.fetch_message(self.signup_message_id)
-                    emoji = next((e for e,r in EMOJI_TO_ROLE.items() if r==role_id), None)
-                    if emoji:
-                        try:
-                            member = guild.get_member(user_id) or await guild.fetch_member(user_id)
-                            await msg.remove_reaction(emoji, member)
-                        except Exception:
-                            pass
-            except Exception:
-                pass
+    def _signup_role(self, payload: discord.RawReactionActionEvent) -> Optional[int]:
+        pt = self.primetime.by_message.get(payload.message_id)
+        if pt is None or pt.guild_id != payload.guild_id:
+            return None
+        return pt.roles.get(str(payload.emoji))
 
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if payload.guild_id != MAIN_GUILD_ID:
-            return
-        if self.signup_message_id is None or payload.message_id != self.signup_message_id:
-            return
         if payload.user_id == self.user.id:
             return
-        emoji_str = str(payload.emoji)
-        role_id = self._role_for_emoji(emoji_str)
+        role_id = self._signup_role(payload)
         if not role_id:
             return
-        guild = self.get_guild(payload.guild_id)
-        if not guild:
-            return
-        await self._add_pending_role(guild, payload.user_id, role_id)
+        self.reaction_pipeline.push(payload.guild_id, payload.user_id, role_id, True)
 
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        if payload.guild_id != MAIN_GUILD_ID:
-            return
-        if self.signup_message_id is None or payload.message_id != self.signup_message_id:
-            return
-        emoji_str = str(payload.emoji)
-        role_id = self._role_for_emoji(emoji_str)
+        role_id = self._signup_role(payload)
         if not role_id:
             return
-        guild = self.get_guild(payload.guild_id)
-        if not guild:
+        self.reaction_pipeline.push(payload.guild_id, payload.user_id, role_id, False)
+
+    async def _apply_signup(self, guild_id: int, user_id: int, role_id: int, want: bool):
+        guild = self.get_guild(guild_id)
+        pt = self.primetime.by_guild.get(guild_id)
+        if not guild or pt is None:
             return
+        if want:
+            await self._add_pending_role(pt, guild, user_id, role_id)
+        else:
+            await self._drop_pending_role(pt, guild, user_id, role_id)
+
+    @METRICS.timed("_drop_pending_role")
+    async def _drop_pending_role(self, pt: PrimeTimeGuild, guild: discord.Guild, user_id: int, role_id: int):
         try:
-            member = guild.get_member(payload.user_id) or await guild.fetch_member(payload.user_id)
+            member = await self.member_resolver.get(guild, user_id)
             role = guild.get_role(role_id)
             if role and role in member.roles:
                 await member.remove_roles(role, reason="PrimeTime: usunięcie reakcji")
         except Exception:
-            pass
-        self.pending.get(role_id, set()).discard(payload.user_id)
-
-    async def primetime_loop(self):
-        while not self.is_closed():
-            now = datetime.now(timezone.utc)
-            next_tick = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
-            await asyncio.sleep(max(1.0, (next_tick - now).total_seconds()))
+            METRICS.swallowed()
+        pt.pending.get(role_id, set()).discard(user_id)
+        self.state.touch()
+
+    def _end_catchup(self):
+        self.catchup = False
+        log.info("PrimeTime: koniec okna nadrabiania po starcie")
+
+    def _maintenance(self):
+        self.member_resolver.prune()
+        for pt in self.primetime:
+            pt.announced.prune()
+        self.scheduler.after("maintenance", MAINTENANCE_INTERVAL, self._maintenance)
+
+    def _arm_cooldown(self, pt: PrimeTimeGuild, role_id: int, last: datetime):
+        self.scheduler.at(f"cooldown:{pt.guild_id}:{role_id}", last + PING_COOLDOWN, lambda: self._cooldown_over(pt, role_id))
+
+    def _cooldown_over(self, pt: PrimeTimeGuild, role_id: int):
+        # ogłoszenie odrzucone w trakcie cooldownu nie przepada — po jego końcu przeglądamy kanał jeszcze raz
+        if role_id in pt.deferred:
+            pt.deferred.discard(role_id)
+            self._schedule_catchup(pt)
+
+    def _schedule_catchup(self, pt: Optional[PrimeTimeGuild] = None):
+        for pt in ([pt] if pt else self.primetime):
+            if pt.task is None or pt.task.done():
+                pt.task = asyncio.create_task(self.scan_and_ping(pt))
+
+    async def on_guild_emojis_update(self, guild: discord.Guild, before, after):
+        if HUB_ID and guild.id == HUB_ID:
+            _set_hub_emoji(after)
+
+    async def on_resumed(self):
+        self._schedule_catchup()
+
+    async def on_message(self, message: discord.Message):
+        await self._handle_em_message(message)
+
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        await self._handle_em_message(after)
+
+    async def _handle_em_message(self, msg: discord.Message):
+        pt = self.primetime.by_channel.get(msg.channel.id)
+        if pt is None or not msg.guild or msg.guild.id != pt.guild_id:
+            return
+        if not _is_text_channel(msg.channel):
+            return
+        # edycja starego ogłoszenia nie jest nowym EM — rozpatrujemy tylko to, co mieści się w oknie skanu
+        created = msg.created_at if msg.created_at.tzinfo else msg.created_at.replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) - created > self._lookback():
+            return
+        role_id = self._classify(pt, msg)
+        if role_id:
             try:
-                await self.scan_and_ping()
+                await self._maybe_ping(pt, msg.guild, msg.channel, role_id, msg)
             except Exception:
-                pass
+                METRICS.swallowed()
 
     def _msg_text(self, msg: discord.Message) -> str:
         parts: List[str] = []
@@ -318,6 +1215,7 @@ class MyClient(discord.Client):
                 if e.author and getattr(e.author, "name", None):
                     parts.append(e.author.name)
             except Exception:
+                METRICS.swallowed()
                 continue
         return "\n".join(parts)
 
@@ -331,42 +1229,29 @@ class MyClient(discord.Client):
                 if m.author.id in {SELF_BOT_ID, (self.user.id if self.user else 0)} and mention in (m.content or ""):
                     return m.created_at if m.created_at.tzinfo else m.created_at.replace(tzinfo=timezone.utc)
         except Exception:
+            METRICS.swallowed()
             return None
         return None
 
-    async def scan_and_ping(self):
-        guild = self.get_guild(MAIN_GUILD_ID)
+    @METRICS.timed("scan_and_ping")
+    async def scan_and_ping(self, pt: PrimeTimeGuild):
+        guild = self.get_guild(pt.guild_id)
         if not guild:
             return
-        ch = guild.get_channel(EM_CHANNEL_ID)
-        if not isinstance(ch, discord.TextChannel):
-            try:
-                ch = await self.fetch_channel(EM_CHANNEL_ID)  # type: ignore
-            except Exception:
-                return
-        if not isinstance(ch, discord.TextChannel):
+        ch = await self._text_channel(guild, pt.em_channel_id)
+        if ch is None:
             return
 
-        now = datetime.now(timezone.utc)
-        within_catchup = (now - self.start_time) < timedelta(minutes=30)
-        lookback_minutes = 30 if within_catchup else 12
-        since = now - timedelta(minutes=lookback_minutes)
+        since = datetime.now(timezone.utc) - self._lookback()
 
         matched: List[Tuple[int, discord.Message]] = []
         try:
             async for msg in ch.history(after=since, limit=200, oldest_first=False):
-                if msg.author and (msg.author.id == SELF_BOT_ID or msg.author.id == (self.user.id if self.user else 0)):
-                    continue
-                c = self._msg_text(msg)
-                if not c:
-                    continue
-                if any(s in c for s in MATCH_300GL):
-                    matched.append((ROLE_PREMKA300, msg))
-                elif any(s in c for s in MATCH_200OR):
-                    matched.append((ROLE_PREMKAZWK, msg))
-                elif any(s in c for s in MATCH_200BTH):
-                    matched.append((ROLE_PREMKAHORY, msg))
+                role_id = self._classify(pt, msg)
+                if role_id:
+                    matched.append((role_id, msg))
         except Exception:
+            METRICS.swallowed()
             return
 
         by_role_latest: Dict[int, discord.Message] = {}
@@ -375,36 +1260,119 @@ class MyClient(discord.Client):
             if prev is None or m.created_at > prev.created_at:
                 by_role_latest[role_id] = m
 
-        cooldown = timedelta(minutes=30)
-
         for role_id, msg in by_role_latest.items():
-            if (last := self.last_ping.get(role_id)) and (now - last) < cooldown:
-                continue
+            try:
+                await self._maybe_ping(pt, guild, ch, role_id, msg)
+            except Exception:
+                METRICS.swallowed()
 
-            if role_id not in self.last_ping and within_catchup:
-                prev_ts = await self._find_recent_self_ping(ch, role_id, within_minutes=30)
-                if prev_ts:
-                    self.last_ping[role_id] = prev_ts
-                    continue
+    def _lookback(self) -> timedelta:
+        return EM_LOOKBACK_CATCHUP if self.catchup else EM_LOOKBACK
+
+    def _classify(self, pt: PrimeTimeGuild, msg: discord.Message) -> Optional[int]:
+        if msg.author and (msg.author.id == SELF_BOT_ID or msg.author.id == (self.user.id if self.user else 0)):
+            return None
+        return pt.classify(msg)
 
+    async def _maybe_ping(self, pt: PrimeTimeGuild, guild: discord.Guild, ch: discord.TextChannel, role_id: int, msg: discord.Message):
+        async with pt.ping_lock:
+            now = datetime.now(timezone.utc)
+            if (last := pt.last_ping.get(role_id)) and (now - last) < PING_COOLDOWN:
+                if (role_id, msg.id) not in pt.announced:
+                    pt.deferred.add(role_id)
+                return
+            # świeży stan z dysku zna ostatnie pingi, więc przegląd historii kanału jest zbędny
+            if role_id not in pt.last_ping and self.catchup and not self.state_fresh:
+                prev_ts = await self._find_recent_self_ping(ch, role_id, within_minutes=int(PING_COOLDOWN.total_seconds() // 60))
+                if prev_ts:
+                    pt.last_ping[role_id] = prev_ts
+                    self._arm_cooldown(pt, role_id, prev_ts)
+                    self.state.touch()
+                    return
             key = (role_id, msg.id)
-            if key in self.announced:
-                continue
+            if key in pt.announced:
+                return
+            mention = f"<@&{role_id}>"
+            text = self._msg_text(msg).strip() or 'Prime Time'
+            await ch.send(f"{mention} — {text}")
+            METRICS.observe("ping_delay", (datetime.now(timezone.utc) - msg.created_at).total_seconds())
+            # partnerzy dostają to samo w tle — wolny lub martwy cel nie blokuje pingu ani sprzątania
+            if pt.webhooks:
+                self.broadcaster.fanout(pt.webhooks, f"{pt.emoji_for.get(role_id, '')} {text}".strip())
+            if self.first_ping_at is None:
+                self.first_ping_at = (datetime.now(timezone.utc) - self.start_time).total_seconds()
+                METRICS.observe("bootstrap:first_ping", self.first_ping_at)
+            pt.announced.add(key)
+            log.info(f"PrimeTime ping <@&{role_id}> na {guild.id} (wiadomość {msg.id}, dedupe: {len(pt.announced)})")
+            pt.last_ping[role_id] = now
+            pt.deferred.discard(role_id)
+            self._arm_cooldown(pt, role_id, now)
+            users = list(pt.pending.get(role_id, set()))
+            pt.pending.setdefault(role_id, set()).difference_update(users)
+            pt.cleaning.add(role_id)
+            self.state.touch()
+        try:
+            await self._bulk_cleanup(pt, guild, role_id, users)
+        finally:
+            pt.cleaning.discard(role_id)
 
-            try:
-                mention = f"<@&{role_id}>"
-                await ch.send(f"{mention} — {self._msg_text(msg).strip() or 'Prime Time'}")
-                self.announced.add(key)
-                self.last_ping[role_id] = now
-                users = list(self.pending.get(role_id, set()))
-                for uid in users:
+    @METRICS.timed("_bulk_cleanup")
+    async def _bulk_cleanup(self, pt: PrimeTimeGuild, guild: discord.Guild, role_id: int, user_ids: List[int]):
+        if not user_ids:
+            return
+        t0 = time.perf_counter()
+        role = guild.get_role(role_id)
+        emoji = pt.emoji_for.get(role_id)
+        msg: Optional[discord.PartialMessage] = None
+        if pt.signup_message_id and emoji:
+            ch = await self._text_channel(guild, pt.signup_channel_id)
+            if ch is not None:
+                msg = ch.get_partial_message(pt.signup_message_id)
+                if CLEANUP_CLEAR_EMOJI and ch.permissions_for(guild.me).manage_messages:
                     try:
-                        await self._remove_pending_role_and_reaction(guild, uid, role_id)
+                        queued = self.reaction_pipeline.snapshot_role(role_id)
+                        await msg.clear_reaction(emoji)
+                        self.reaction_pipeline.forget(queued)
+                        await self._ensure_reactions(msg, [emoji])
+                        msg = None
                     except Exception:
-                        pass
-                self.pending[role_id].clear()
-            except Exception:
-                pass
+                        METRICS.swallowed()
+
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for uid in user_ids:
+            queue.put_nowait(uid)
+        total = len(user_ids)
+        step = max(1, total // 10)
+        done = 0
+
+        async def clean_one(uid: int):
+            member = guild.get_member(uid)
+            if role and (member is None or role in member.roles):
+                try:
+                    await self.http.remove_role(guild.id, uid, role.id, reason="PrimeTime one-shot zakończony")
+                except Exception:
+                    METRICS.swallowed()
+            if msg is not None:
+                try:
+                    await msg.remove_reaction(emoji, member or discord.Object(id=uid))
+                except Exception:
+                    METRICS.swallowed()
+
+        async def worker():
+            nonlocal done
+            while True:
+                try:
+                    uid = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await clean_one(uid)
+                done += 1
+                if done % step == 0 and done < total:
+                    log.info(f"Sprzątanie PrimeTime <@&{role_id}>: {done}/{total}")
+
+        # discord.py sam pilnuje kubełków rate-limitu per trasa; pula tylko ogranicza liczbę żądań w locie
+        await asyncio.gather(*(worker() for _ in range(min(CLEANUP_WORKERS, total))))
+        log.info(f"Sprzątanie PrimeTime <@&{role_id}>: {total} użytkowników w {time.perf_counter()-t0:.2f}s")
 
 def fmt_int(x): return f"{int(round(float(x))):,}".replace(","," ")
 def _to_int(s):
@@ -449,10 +1417,18 @@ async def load_hub_emoji(client: discord.Client):
     try:
         g = client.get_guild(HUB_ID) or await client.fetch_guild(HUB_ID)
         emojis = await g.fetch_emojis()
-        for e in emojis:
-            HUB_EMOJI_ID[e.name] = e.id
+        _set_hub_emoji(emojis)
     except Exception:
-        pass
+        METRICS.swallowed()
+
+def _set_hub_emoji(emojis):
+    HUB_EMOJI_ID.clear()
+    for e in emojis:
+        HUB_EMOJI_ID[e.name] = e.id
+    E_TABLE.clear(); M_TABLE.clear()
+    for k in RES_KEYS: E(k)
+    for k in MEDAL_ALIAS: M(k)
+    _embed_spec.cache_clear(); _liga_embed_spec.cache_clear()
 
 def _app(name: str) -> Optional[str]:
     eid = HUB_EMOJI_ID.get(name)
@@ -470,19 +1446,29 @@ RES_KEYS={
  "decor":["Dekorka","dekorka"],
  "rubies":["rubiny"],
 }
-def E(key:str)->str:
+E_TABLE:Dict[str,str]={}
+M_TABLE:Dict[str,str]={}
+def _resolve_E(key:str)->str:
     for nm in RES_KEYS.get(key, []):
         for nn in HUB_NAMES.get(nm, [nm]):
             s=_app(nn)
             if s: return s
     return UNI.get(key, "•")
-def M(key:str)->str:
+def _resolve_M(key:str)->str:
     alias=MEDAL_ALIAS.get(key)
     if alias:
         for nn in HUB_NAMES.get(alias,[alias]):
             s=_app(nn)
             if s: return s
     return MEDAL_UNI.get(key,"🔸")
+def E(key:str)->str:
+    s=E_TABLE.get(key)
+    if s is None: s=E_TABLE[key]=_resolve_E(key)
+    return s
+def M(key:str)->str:
+    s=M_TABLE.get(key)
+    if s is None: s=M_TABLE[key]=_resolve_M(key)
+    return s
 
 COST_PER_POINT={"charter":1,"construction":3,"sceat":5,"upgrade":8,"samurai_medals":63,"samurai_tokens":2050,"khan_medals":14200,"khan_tablets":5400}
 LEVEL_COSTS=[310,915,2030,3600,5280,6650,9300,13300,14600,25200]
@@ -491,22 +1477,34 @@ PL_NAME={"charter":"Żetony patronatu","construction":"Żetony budowy","sceat":"
 
 def calc_points(**spent): return sum((float(v)/COST_PER_POINT[k]) for k,v in spent.items() if v)
 
+LEVEL_CUM=list(accumulate(LEVEL_COSTS,initial=0))
+LEVEL_CUM_FROM=[[c-LEVEL_CUM[b] for c in LEVEL_CUM[b:]] for b in range(len(LEVEL_CUM))]
+
+def level_from_points(pts:float,base:int=0)->Tuple[int,float]:
+    base=max(0,min(10,int(base))); pts=float(max(0,pts)); cum=LEVEL_CUM_FROM[base]
+    i=bisect_right(cum,pts)-1
+    return base+i,pts-cum[i]
+
+def points_to_level(lv:int,prog:float,target:int)->float:
+    if lv>=10: return 0
+    need=LEVEL_COSTS[lv]-prog
+    return need+(LEVEL_CUM[target]-LEVEL_CUM[lv+1]) if target>lv+1 else need
+
 def walk_levels(lv,prog,gain):
     lv=max(0,min(10,int(lv))); prog=float(max(0,prog)); pool=float(max(0,gain))
     if lv>=10: return 10,0.0,None,prog+pool
-    while lv<10:
-        need=LEVEL_COSTS[lv]-prog
-        if pool>=need:
-            pool-=need; lv+=1; prog=0.0
-        else:
-            prog+=pool; pool=0.0; break
-        if lv==10: return 10,0.0,None,pool
-    nxt=LEVEL_COSTS[lv]-prog if lv<10 else None
-    return lv,prog,nxt,None
+    need=LEVEL_COSTS[lv]-prog
+    if pool<need:
+        prog+=pool; return lv,prog,LEVEL_COSTS[lv]-prog,None
+    pool-=need; cum=LEVEL_CUM_FROM[lv+1]; i=bisect_right(cum,pool)-1
+    lv+=1+i; prog=pool-cum[i]
+    if lv>=10: return 10,0.0,None,prog
+    return lv,prog,LEVEL_COSTS[lv]-prog,None
 
 P_PACKS=[{"amount":32500,"price":625000,"limit":1},{"amount":3250,"price":70000,"limit":1},{"amount":3250,"price":79000,"limit":2},{"amount":3250,"price":85000,"limit":3},{"amount":325,"price":7000,"limit":3},{"amount":325,"price":7900,"limit":10},{"amount":325,"price":8800,"limit":50},{"amount":35,"price":700,"limit":5},{"amount":35,"price":800,"limit":10},{"amount":35,"price":900,"limit":50}]
 SINGLE_PRICE=35
-def best_ruby_cost_for_charters(req:int)->Tuple[int,str,float]:
+RUBY_TABLE_CEIL=int(os.getenv("RUBY_TABLE_CEIL") or 0)
+def _greedy_ruby_cost_for_charters(req:int)->Tuple[int,str,float]:
     req=max(0,int(req))
     if req==0: return 0,"",0.0
     packs=[dict(p) for p in P_PACKS]; packs.sort(key=lambda p:(p["price"]/p["amount"],-p["amount"]))
@@ -527,6 +1525,9 @@ def best_ruby_cost_for_charters(req:int)->Tuple[int,str,float]:
             total+=rem*SINGLE_PRICE; buys.append((1,SINGLE_PRICE,rem)); rem=0
         else:
             p=packs[best_i]; total+=p["price"]; buys.append((p["amount"],p["price"],1)); rem=max(0,rem-p["amount"]); p["limit"]-=1
+    return _ruby_plan(req,total,buys)
+
+def _ruby_plan(req:int,total:int,buys:List[Tuple[int,int,int]])->Tuple[int,str,float]:
     agg:Dict[Tuple[int,int],int]={}
     for a,pr,c in buys:
         agg[(a,pr)]=agg.get((a,pr),0)+c
@@ -535,11 +1536,53 @@ def best_ruby_cost_for_charters(req:int)->Tuple[int,str,float]:
     avg= total/req if req>0 else 0.0
     return int(round(total)), plan, avg
 
-SESS:Dict[int,dict]={}
-def _new_s(): return {"charter":0,"construction":0,"sceat":0,"upgrade":0,"samurai_medals":0,"samurai_tokens":0,"khan_medals":0,"khan_tablets":0,"current_level":0,"current_progress":0,"target_level":0}
-def _s(uid:int)->dict:
-    if uid not in SESS: SESS[uid]=_new_s()
-    return SESS[uid]
+@lru_cache(maxsize=None)
+def _ruby_table():
+    unit=0
+    for p in P_PACKS: unit=math.gcd(unit,p["amount"])
+    items=[]
+    for i,p in enumerate(P_PACKS):
+        k,left=1,p["limit"]
+        while left>0:
+            c=min(k,left); items.append((p["amount"]*c//unit,p["price"]*c,i,c)); left-=c; k*=2
+    full=sum(p["amount"]*p["limit"] for p in P_PACKS)//unit
+    size=min(full,-(-RUBY_TABLE_CEIL//unit)) if RUBY_TABLE_CEIL>0 else full
+    cost=[x*unit*SINGLE_PRICE for x in range(size+2)]
+    take=[]
+    for a,p,_,_ in items:
+        prev=cost[:]; t=bytearray(len(cost))
+        for x in range(len(cost)):
+            c=(prev[x-a] if x>a else 0)+p
+            if c<prev[x]: cost[x]=c; t[x]=1
+        take.append(t)
+    return unit,items,cost,take,size>=full
+
+def _ruby_backtrack(x:int)->Tuple[List[Tuple[int,int,int]],int]:
+    unit,items,_,take,_=_ruby_table()
+    used:Dict[int,int]={}
+    for j in range(len(items)-1,-1,-1):
+        if take[j][x]:
+            a,_,i,c=items[j]; used[i]=used.get(i,0)+c; x=max(0,x-a)
+    return [(P_PACKS[i]["amount"],P_PACKS[i]["price"],c) for i,c in used.items()],x*unit
+
+@lru_cache(maxsize=1024)
+def best_ruby_cost_for_charters(req:int)->Tuple[int,str,float]:
+    req=max(0,int(req))
+    if req==0: return 0,"",0.0
+    unit,_,cost,_,exact=_ruby_table()
+    q,r=divmod(req,unit); top=len(cost)-2
+    if q>top:
+        if not exact: return _greedy_ruby_cost_for_charters(req)
+        buys,singles=_ruby_backtrack(top)
+        singles+=req-top*unit
+    elif cost[q]+r*SINGLE_PRICE<=cost[q+1]:
+        buys,singles=_ruby_backtrack(q); singles+=r
+    else:
+        buys,singles=_ruby_backtrack(q+1)
+    if singles: buys.append((1,SINGLE_PRICE,singles))
+    return _ruby_plan(req,sum(pr*c for _,pr,c in buys),buys)
+
+SESS=SessionStore("patronat",{"charter":0,"construction":0,"sceat":0,"upgrade":0,"samurai_medals":0,"samurai_tokens":0,"khan_medals":0,"khan_tablets":0,"current_level":0,"current_progress":0,"target_level":0},STATE_DB,SESSION_CACHE)
 
 ORDER=["charter","sceat","construction","upgrade","samurai_medals","samurai_tokens","khan_medals","khan_tablets"]
 def _spent_lines(s):
@@ -550,10 +1593,36 @@ def _spent_lines(s):
             parts.append(f"{E(k)} **{PL_NAME[k]}:** {fmt_int(v)}")
     return "\n".join(parts) if parts else "—"
 
-def _embed(guild, s, show=False):
+class _EmbedSpec:
+    def __init__(self,title=None,color=None): self.title=title; self.color=color; self.fields=[]; self.footer=None
+    def add_field(self,*,name,value,inline=True): self.fields.append((name,value,inline))
+    def set_footer(self,*,text): self.footer=text
+    def build(self)->discord.Embed:
+        emb=discord.Embed(title=self.title,color=self.color)
+        for n,v,inl in self.fields: emb.add_field(name=n,value=v,inline=inl)
+        if self.footer: emb.set_footer(text=self.footer)
+        return emb
+
+def _state_key(s:dict)->Tuple[Tuple[str,int],...]: return tuple(sorted(s.items()))
+
+def render_cache_stats()->Dict[str,Dict[str,float]]:
+    out={}
+    for name,fn in (("patronat",_embed_spec),("liga",_liga_embed_spec)):
+        ci=fn.cache_info(); tot=ci.hits+ci.misses
+        out[name]={"hits":ci.hits,"misses":ci.misses,"size":ci.currsize,"hit_rate":ci.hits/tot if tot else 0.0}
+    return out
+
+METRICS.gauges["render_cache_hit_rate_patronat"]=lambda: render_cache_stats()["patronat"]["hit_rate"]
+METRICS.gauges["render_cache_hit_rate_liga"]=lambda: render_cache_stats()["liga"]["hit_rate"]
+
+def _embed(guild, s, show=False): return _embed_spec(_state_key(s),bool(show)).build()
+
+@lru_cache(maxsize=RENDER_CACHE)
+def _embed_spec(state, show):
+    s=dict(state)
     gained=calc_points(charter=s["charter"],construction=s["construction"],sceat=s["sceat"],upgrade=s["upgrade"],samurai_medals=s["samurai_medals"],samurai_tokens=s["samurai_tokens"],khan_medals=s["khan_medals"],khan_tablets=s["khan_tablets"])
     lv,prog,nxt,overflow=walk_levels(s["current_level"],s["current_progress"],gained)
-    emb=discord.Embed(title=f"{E('decor')} Dekoracja — panel",color=0x2ecc71)
+    emb=_EmbedSpec(title=f"{E('decor')} Dekoracja — panel",color=0x2ecc71)
     emb.add_field(name="🧾 Wydatki",value=_spent_lines(s),inline=False)
     if s["current_level"]>0 or s["current_progress"]>0:
         emb.add_field(name="🧭 Stan początkowy",value=f"Poziom: **{s['current_level']}**\nPunkty w poziomie: **{fmt_int(s['current_progress'])}**",inline=True)
@@ -572,11 +1641,7 @@ def _embed(guild, s, show=False):
         emb.set_footer(text=f"Średni koszt 1 pkt: {avg:.2f} rub.")
     if show and s["target_level"]:
         target=int(s["target_level"])
-        if lv>=10: need=0
-        else:
-            need=LEVEL_COSTS[lv]-prog
-            for L in range(lv+1,target):
-                need+=LEVEL_COSTS[L]
+        need=points_to_level(lv,prog,target)
         if need>0:
             rub2,plan2,_=best_ruby_cost_for_charters(need)
             emb.add_field(name=f"🎯 Koszt do poziomu {target} (żetony patronatu)",value=(f"Żetony patronatu: **{fmt_int(need)}**\n{E('rubies')} Rubiny: **{fmt_int(rub2)}**\nPlan:\n{plan2}") if plan2 else f"Żetony patronatu: **{fmt_int(need)}**\n{E('rubies')} Rubiny: **{fmt_int(rub2)}**",inline=False)
@@ -585,12 +1650,14 @@ def _embed(guild, s, show=False):
     return emb
 
 @app_commands.command(name="pomoc",description="Lista komend")
+@METRICS.timed("cmd:pomoc")
 async def pomoc(i:discord.Interaction):
     d=(
         "**/patronat** — panel dekoracji\n"
         "**/liga** — Tytuły z medali\n"
         "**/tytul** — kiedy tracisz bonus z chwały / Berimond\n"
-        "**/zbieracz** — ile musisz zdobyć punktów, by spełnić swój cel"
+        "**/zbieracz** — ile musisz zdobyć punktów, by spełnić swój cel\n"
+        "**/sojusz** — /zbieracz i /tytul dla całego sojuszu z pliku CSV"
     )
     await i.response.send_message(
         embed=discord.Embed(title="📚 Pomoc",description=d,color=0x3498DB),
@@ -598,8 +1665,9 @@ async def pomoc(i:discord.Interaction):
     )
 
 @app_commands.command(name="patronat",description="Panel liczenia dekoracji")
+@METRICS.timed("cmd:patronat")
 async def patronat_cmd(i:discord.Interaction):
-    await i.response.send_message(embed=_embed(i.guild,_s(i.user.id),False),view=DekorView(i.user.id),ephemeral=True)
+    await i.response.send_message(embed=_embed(i.guild,await SESS.get(i.user.id),False),view=panel_view("patronat",i.user.id),ephemeral=True)
 
 MEDALS=[("gold","Złoty",1000),("silver","Srebrny",950),("bronze","Brązowy",850),("glass","Szklany",700),("copper","Miedziany",500),("stone","Kamienny",300),("wood","Drewniany",100)]
 TITLES=["Zadziora","Awanturnik","Rozrabiaka","Wprawny Rozrabiaka","Łowca","Łowca Głów","Wytrawny Łowca","Mistrzowski Łowca","Strażnik","Strażnik Zamkowy","Strażnik Dworu","Strażnik Tronu","Wojownik","Dzielny Wojownik","Doświadczony Wojownik","Bohaterski Wojownik","Pan Wojny","Wielki Pan Wojny","Najwyższy Pan Wojny","Pan Wojny Totalnej","Niszczyciel"]
@@ -622,11 +1690,8 @@ def weak_two(need):
             if p1+p2>=need: return k1,k2
     return WEAK[0][0],WEAK[0][0]
 
-LIGA:Dict[int,dict]={}
-def _new_l(): return {k:0 for k,_,_ in MEDALS}
-def _l(uid):
-    if uid not in LIGA: LIGA[uid]=_new_l()
-    return LIGA[uid]
+LIGA=SessionStore("liga",{k:0 for k,_,_ in MEDALS},STATE_DB,SESSION_CACHE)
+METRICS.gauges["sessions_cached"]=lambda: len(SESS._lru)+len(LIGA._lru)
 
 def _medals_text(s):
     parts=[]
@@ -635,9 +1700,13 @@ def _medals_text(s):
         if c>0: parts.append(f"{M(k)} × **{fmt_int(c)}**")
     return "\n".join(parts) if parts else "—"
 
-def _liga_embed(g,s):
+def _liga_embed(g,s): return _liga_embed_spec(_state_key(s)).build()
+
+@lru_cache(maxsize=RENDER_CACHE)
+def _liga_embed_spec(state):
+    s=dict(state)
     t=liga_points(s); idx,cur,nxt,inb,need=title_from_points(t)
-    emb=discord.Embed(title="🏰 Liga — tytuły z medali",color=0x5865F2)
+    emb=_EmbedSpec(title="🏰 Liga — tytuły z medali",color=0x5865F2)
     emb.add_field(name="🎖️ Medale",value=_medals_text(s),inline=False)
     if nxt:
         post=f"❗ Nadwyżka: **{fmt_int(inb)}**\n⏭️ Brakuje: **{fmt_int(need)}**\n"
@@ -658,11 +1727,14 @@ class L1(discord.ui.Modal, title="Medale — 1/2"):
     silver=discord.ui.TextInput(label="Srebrny",required=False)
     bronze=discord.ui.TextInput(label="Brązowy",required=False)
     glass=discord.ui.TextInput(label="Szklany",required=False)
+    @METRICS.timed("modal:liga:m1")
     async def on_submit(self,i):
         try:
             self.s["gold"]=_to_int(self.gold.value); self.s["silver"]=_to_int(self.silver.value); self.s["bronze"]=_to_int(self.bronze.value); self.s["glass"]=_to_int(self.glass.value)
+            await LIGA.save(i.user.id,self.s)
             await i.response.send_message("Zapisano (1/2). Kliknij **Zapisz**.",ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd (1/2).",ephemeral=True)
 
 class L2(discord.ui.Modal, title="Medale — 2/2"):
@@ -670,32 +1742,20 @@ class L2(discord.ui.Modal, title="Medale — 2/2"):
     copper=discord.ui.TextInput(label="Miedziany",required=False)
     stone=discord.ui.TextInput(label="Kamienny",required=False)
     wood=discord.ui.TextInput(label="Drewniany",required=False)
+    @METRICS.timed("modal:liga:m2")
     async def on_submit(self,i):
         try:
             self.s["copper"]=_to_int(self.copper.value); self.s["stone"]=_to_int(self.stone.value); self.s["wood"]=_to_int(self.wood.value)
+            await LIGA.save(i.user.id,self.s)
             await i.response.send_message("Zapisano (2/2). Kliknij **Zapisz**.",ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd (2/2).",ephemeral=True)
 
-class LigaView(discord.ui.View):
-    def __init__(self,uid): super().__init__(timeout=600); self.uid=uid
-    async def interaction_check(self,i):
-        if i.user.id!=self.uid:
-            await i.response.send_message("To prywatny panel innego użytkownika.",ephemeral=True)
-            return False
-        return True
-    @discord.ui.button(label="1",style=discord.ButtonStyle.primary,emoji="🎖️")
-    async def a(self,i,_): await i.response.send_modal(L1(_l(self.uid)))
-    @discord.ui.button(label="2",style=discord.ButtonStyle.primary,emoji="🏅")
-    async def b(self,i,_): await i.response.send_modal(L2(_l(self.uid)))
-    @discord.ui.button(label="Zapisz",style=discord.ButtonStyle.success,emoji="🔄")
-    async def c(self,i,_): await i.response.edit_message(embed=_liga_embed(i.guild,_l(self.uid)),view=self)
-    @discord.ui.button(label="Wyczyść",style=discord.ButtonStyle.danger,emoji="🧹")
-    async def d(self,i,_): LIGA[self.uid]=_new_l(); await i.response.edit_message(embed=_liga_embed(i.guild,_l(self.uid)),view=self)
-
 @app_commands.command(name="liga",description="Tytuły z medali")
+@METRICS.timed("cmd:liga")
 async def liga_cmd(i:discord.Interaction):
-    await i.response.send_message(embed=_liga_embed(i.guild,_l(i.user.id)),view=LigaView(i.user.id),ephemeral=True)
+    await i.response.send_message(embed=_liga_embed(i.guild,await LIGA.get(i.user.id)),view=panel_view("liga",i.user.id),ephemeral=True)
 
 def parse_yn_optional(val: str) -> Optional[bool]:
     s = str(val or "").strip().lower()
@@ -724,12 +1784,18 @@ def _beri_rate_and_boundary(cur: float) -> Tuple[float, int]:
     else:
         return 7.0, 145_000
 
+BERI_THRESHOLDS: Tuple[int, ...] = (195_000, 95_000, 37_500)
+GLORY_SPEED_THRESHOLD = 22_724_097
+
 def days_until_below_berimond(current: int, threshold: int) -> int:
     c = float(max(0, int(current)))
     t = float(max(0, int(threshold)))
     if c < t: return 0
     if c == t: return 1
-    days = 0
+    return _beri_walk(c, 0, t)
+
+def _beri_walk(c: float, days: int, t: float) -> int:
+    if days > 10000: return days
     while c > t:
         rate, boundary = _beri_rate_and_boundary(c)
         r = rate / 100.0
@@ -743,11 +1809,41 @@ def days_until_below_berimond(current: int, threshold: int) -> int:
         if days > 10000: break
     return days
 
+def berimond_days_many(current: int, thresholds: Sequence[int] = BERI_THRESHOLDS) -> List[int]:
+    c = float(max(0, int(current)))
+    ts = [float(max(0, int(t))) for t in thresholds]
+    if not ts: return []
+    lo = min(ts)
+    path: List[Tuple[float, int, int]] = []
+    days = 0
+    while days <= 10000:
+        rate, boundary = _beri_rate_and_boundary(c)
+        path.append((c, days, boundary))
+        if boundary <= lo or c <= boundary: break
+        n = days_until_below(int(c), boundary, rate)
+        if n <= 0: n = 1
+        days += n
+        c = c * ((1.0 - rate / 100.0) ** n)
+    else:
+        path.append((c, days, 0))
+    out: List[int] = []
+    for t in ts:
+        if path[0][0] < t: out.append(0); continue
+        if path[0][0] == t: out.append(1); continue
+        for pc, pd, pb in path:
+            if pc <= t or pb <= t: break
+        out.append(_beri_walk(pc, pd, t))
+    return out
+
+def berimond_days_batch(currents: Iterable[int], thresholds: Sequence[int] = BERI_THRESHOLDS) -> List[List[int]]:
+    return [berimond_days_many(c, thresholds) for c in currents]
+
 class ZbieraczModal(discord.ui.Modal, title="Zbieracz — kalkulator"):
     def __init__(self): super().__init__(custom_id="zbieracz:m")
     cur=discord.ui.TextInput(label="Twoje punkty teraz",required=True)
     days=discord.ui.TextInput(label="Dni do końca",required=True,max_length=3)
     goal=discord.ui.TextInput(label="Cel punktowy",required=True)
+    @METRICS.timed("modal:zbieracz:m")
     async def on_submit(self,i):
         try:
             cur=_to_int(self.cur.value); days=_to_int(self.days.value); goal=_to_int(self.goal.value)
@@ -759,6 +1855,7 @@ class ZbieraczModal(discord.ui.Modal, title="Zbieracz — kalkulator"):
             e.add_field(name="🔮 Po tylu pkt. dziś, na koniec będzie",value=f"**{fmt_int(projected)}** pkt",inline=False)
             await i.response.send_message(embed=e,ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd podczas obliczeń.",ephemeral=True)
 
 def required_today(current:int,days_left:int,target:int,mult:float=1.35)->int:
@@ -766,19 +1863,22 @@ def required_today(current:int,days_left:int,target:int,mult:float=1.35)->int:
     need_base= target/(mult**days_left); return max(0, math.ceil(need_base-current))
 
 @app_commands.command(name="zbieracz",description="ile musisz zdobyć punktów, by spełnić swój cel")
+@METRICS.timed("cmd:zbieracz")
 async def zbieracz_cmd(i:discord.Interaction):
     await i.response.send_modal(ZbieraczModal())
 
 @app_commands.command(name="tytul", description="kiedy tracisz bonus z chwały / Berimond")
+@METRICS.timed("cmd:tytul")
 async def tytul_cmd(i: discord.Interaction):
     class TytulModal(discord.ui.Modal, title="Tytuły — dane"):
         def __init__(self): super().__init__(custom_id="tytul:m")
         glory = discord.ui.TextInput(label="Aktualna chwała (opcjonalnie)",required=False,placeholder="np. 30500000")
         sub = discord.ui.TextInput(label="Subskrypcja? (Y/N, opcjonalnie)",required=False,placeholder="Y / N")
         beri = discord.ui.TextInput(label="Punkty Berimond (opcjonalnie)",required=False,placeholder="np. 240000")
+        @METRICS.timed("modal:tytul:m")
         async def on_submit(self, inter: discord.Interaction):
             try:
-                speed_threshold = 22_724_097
+                speed_threshold = GLORY_SPEED_THRESHOLD
                 out_lines: List[str] = []
                 out_lines.append("🎖️ Tytuły")
                 glory_raw = (self.glory.value or "").strip()
@@ -802,10 +1902,8 @@ async def tytul_cmd(i: discord.Interaction):
                         out_lines.append(f"{_sev_emoji(dni)}Utrata bonusu za { _pl_dni(dni) }.")
                 if beri_raw:
                     ber = _to_int(beri_raw)
-                    T1, T2, T3 = 195_000, 95_000, 37_500
-                    d1 = days_until_below_berimond(ber, T1)
-                    d2 = days_until_below_berimond(ber, T2)
-                    d3 = days_until_below_berimond(ber, T3)
+                    T1, T2, T3 = BERI_THRESHOLDS
+                    d1, d2, d3 = berimond_days_many(ber, BERI_THRESHOLDS)
                     out_lines.append("➡️Berimond:")
                     out_lines.append(f"Aktualnie: {fmt_int(ber)}")
                     def line(cur, thr, days, text):
@@ -824,10 +1922,118 @@ async def tytul_cmd(i: discord.Interaction):
                 e = discord.Embed(description="\n".join(out_lines), color=0xE67E22)
                 await inter.response.send_message(embed=e, ephemeral=True)
             except Exception:
+                METRICS.swallowed()
                 await inter.response.send_message("Błąd obliczeń.", ephemeral=True)
     await i.response.send_modal(TytulModal())
 
-ALL_CMDS=[pomoc, patronat_cmd, liga_cmd, tytul_cmd, zbieracz_cmd]
+BATCH_MAX_BYTES = 2_000_000
+BATCH_MAX_ROWS = 20_000
+BATCH_MAX_DAYS = 999
+BATCH_COLS = {
+    "nick": ("nick","gracz","name","player"),
+    "cur": ("punkty","cur","current","points"),
+    "days": ("dni","days"),
+    "goal": ("cel","goal","target"),
+    "glory": ("chwala","chwała","glory"),
+    "sub": ("sub","subskrypcja","subscription"),
+    "beri": ("berimond","beri"),
+}
+BATCH_OUT = ["nick","dzis_do_zdobycia","chwala_dni"]+[f"berimond_{t}_dni" for t in BERI_THRESHOLDS]
+
+def _batch_rows(raw: bytes) -> Tuple[List[Dict[str, str]], int]:
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = raw.decode("cp1250", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(io.StringIO(text), dialect)
+    header = [h.strip().lower() for h in next(reader, [])]
+    idx = {key: next((header.index(a) for a in aliases if a in header), None) for key, aliases in BATCH_COLS.items()}
+    rows: List[Dict[str, str]] = []
+    dropped = 0
+    for rec in reader:
+        if not any(x.strip() for x in rec): continue
+        if len(rows) >= BATCH_MAX_ROWS:
+            dropped += 1; continue
+        rows.append({key: (rec[j].strip() if j is not None and j < len(rec) else "") for key, j in idx.items()})
+    return rows, dropped
+
+def alliance_batch(rows: List[Dict[str, str]]) -> Tuple[List[Dict[str, object]], int]:
+    out: List[Dict[str, object]] = []
+    failed = 0
+    for n, r in enumerate(rows, 1):
+        res: Dict[str, object] = {k: "" for k in BATCH_OUT}
+        res["nick"] = r.get("nick") or f"#{n}"
+        # jeden absurdalny wiersz (np. dni=3000 -> 1.35**3000) zostaje pusty zamiast wywracać cały plik
+        try:
+            if r.get("cur") and r.get("days") and r.get("goal"):
+                days = min(_to_int(r["days"]), BATCH_MAX_DAYS)
+                res["dzis_do_zdobycia"] = required_today(_to_int(r["cur"]), days, _to_int(r["goal"]), 1.35)
+            if r.get("glory"):
+                sub = parse_yn_optional(r.get("sub", ""))
+                res["chwala_dni"] = days_until_below(_to_int(r["glory"]), GLORY_SPEED_THRESHOLD, 8.0 if sub else 10.0)
+            if r.get("beri"):
+                for t, d in zip(BERI_THRESHOLDS, berimond_days_many(_to_int(r["beri"]), BERI_THRESHOLDS)):
+                    res[f"berimond_{t}_dni"] = d
+        except (ArithmeticError, ValueError):
+            res = {k: "" for k in BATCH_OUT}; res["nick"] = r.get("nick") or f"#{n}"
+            failed += 1
+        out.append(res)
+    return out, failed
+
+@app_commands.command(name="sojusz", description="/zbieracz i /tytul dla całego sojuszu z pliku CSV")
+@app_commands.describe(plik="CSV z kolumnami: nick, punkty, dni, cel, chwala, sub, berimond (dowolny podzbiór)")
+@METRICS.timed("cmd:sojusz")
+async def sojusz_cmd(i: discord.Interaction, plik: discord.Attachment):
+    if plik.size > BATCH_MAX_BYTES:
+        await i.response.send_message(f"Plik za duży (maks. {BATCH_MAX_BYTES // 1_000_000} MB).", ephemeral=True)
+        return
+    await i.response.defer(ephemeral=True, thinking=True)
+    try:
+        t0 = time.perf_counter()
+        rows, dropped = _batch_rows(await plik.read())
+        if not rows:
+            await i.followup.send("Plik nie zawiera żadnych wierszy.", ephemeral=True)
+            return
+        res, failed = alliance_batch(rows)
+        buf = io.StringIO()
+        w = csv.DictWriter(buf, fieldnames=BATCH_OUT, delimiter=";")
+        w.writeheader(); w.writerows(res)
+        dt = (time.perf_counter() - t0) * 1000
+        desc = f"Przeliczono **{fmt_int(len(res))}** graczy w {dt:.0f} ms."
+        if failed:
+            desc += f"\n⚠️ {fmt_int(failed)} wierszy z nieprawidłowymi liczbami zostawiono pustych."
+        if dropped:
+            desc += f"\n⚠️ Pominięto {fmt_int(dropped)} wierszy ponad limit {fmt_int(BATCH_MAX_ROWS)}."
+        e = discord.Embed(title="📊 Sojusz — wyniki", description=desc, color=0x00A67E)
+        fname = os.path.splitext(plik.filename)[0] + "_wyniki.csv"
+        await i.followup.send(embed=e, file=discord.File(io.BytesIO(buf.getvalue().encode("utf-8-sig")), filename=fname), ephemeral=True)
+    except Exception:
+        METRICS.swallowed()
+        await i.followup.send("Błąd podczas obliczeń.", ephemeral=True)
+
+@app_commands.command(name="diag", description="Opóźnienia i liczniki bota (tylko właściciel)")
+@app_commands.default_permissions(administrator=True)
+@METRICS.timed("cmd:diag")
+async def diag_cmd(i: discord.Interaction):
+    try:
+        owner = await i.client.is_app_owner(i.user)
+    except Exception:
+        METRICS.swallowed()
+        owner = False
+    if not owner:
+        await i.response.send_message("Tylko dla właściciela bota.", ephemeral=True)
+        return
+    due = "\n".join(f"`{k}` za {max(0, left):.0f} s" for k, left in i.client.scheduler.pending()[:15])
+    e = discord.Embed(title="🩺 Diagnostyka", description=METRICS.report()[:4000], color=0x95A5A6)
+    if due:
+        e.add_field(name="⏰ Zaplanowane", value=due[:1024], inline=False)
+    await i.response.send_message(embed=e, ephemeral=True)
+
+ALL_CMDS=[pomoc, patronat_cmd, liga_cmd, tytul_cmd, zbieracz_cmd, sojusz_cmd, diag_cmd]
 
 class SpendingModal1(discord.ui.Modal, title="Wydatki — 1/2"):
     def __init__(self, s): super().__init__(custom_id="patronat:m1"); self.s=s
@@ -835,12 +2041,15 @@ class SpendingModal1(discord.ui.Modal, title="Wydatki — 1/2"):
     sceat=discord.ui.TextInput(label="Groszaki",required=False)
     construction=discord.ui.TextInput(label="Żetony budowy",required=False)
     upgrade=discord.ui.TextInput(label="Żetony ulepszenia",required=False)
+    @METRICS.timed("modal:patronat:m1")
     async def on_submit(self,i):
         try:
             self.s["charter"]=_to_int(self.charter.value); self.s["sceat"]=_to_int(self.sceat.value)
             self.s["construction"]=_to_int(self.construction.value); self.s["upgrade"]=_to_int(self.upgrade.value)
+            await SESS.save(i.user.id,self.s)
             await i.response.send_message("Zapisano (1/2). Kliknij **Zapisz**.",ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd (1/2).",ephemeral=True)
 
 class SpendingModal2(discord.ui.Modal, title="Wydatki — 2/2"):
@@ -849,14 +2058,17 @@ class SpendingModal2(discord.ui.Modal, title="Wydatki — 2/2"):
     samurai_tokens=discord.ui.TextInput(label="Żetony Samuraja",required=False)
     khan_medals=discord.ui.TextInput(label="Medale Chana",required=False)
     khan_tablets=discord.ui.TextInput(label="Tabliczki Nomada",required=False)
+    @METRICS.timed("modal:patronat:m2")
     async def on_submit(self,i):
         try:
             self.s["samurai_medals"]=_to_int(self.samurai_medals.value)
             self.s["samurai_tokens"]=_to_int(self.samurai_tokens.value)
             self.s["khan_medals"]=_to_int(self.khan_medals.value)
             self.s["khan_tablets"]=_to_int(self.khan_tablets.value)
+            await SESS.save(i.user.id,self.s)
             await i.response.send_message("Zapisano (2/2). Kliknij **Zapisz**.",ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd (2/2).",ephemeral=True)
 
 class StateModal(discord.ui.Modal, title="LVL dekoracji"):
@@ -864,32 +2076,65 @@ class StateModal(discord.ui.Modal, title="LVL dekoracji"):
     level=discord.ui.TextInput(label="Obecny poziom (0–10)",required=False,max_length=2)
     progress=discord.ui.TextInput(label="Punkty wbite w poziom",required=False)
     target=discord.ui.TextInput(label="Docelowy poziom (1–10)",required=False,max_length=2)
+    @METRICS.timed("modal:patronat:state")
     async def on_submit(self,i):
         try:
             self.s["current_level"]=max(0,min(10,_to_int(self.level.value or 0)))
             self.s["current_progress"]=max(0,_to_int(self.progress.value or 0))
             self.s["target_level"]=max(0,min(10,_to_int(self.target.value or 0)))
+            await SESS.save(i.user.id,self.s)
             await i.response.send_message("Parametry zapisane. Kliknij **Zapisz**.",ephemeral=True)
         except:
+            METRICS.swallowed()
             await i.response.send_message("Błąd.",ephemeral=True)
 
-class DekorView(discord.ui.View):
-    def __init__(self,uid): super().__init__(timeout=600); self.uid=uid
-    async def interaction_check(self,i):
-        if i.user.id!=self.uid:
+# Panele są bezstanowe: custom_id = "panel:<rodzaj>:<akcja>:<uid>", sesję czytamy z magazynu przy kliknięciu,
+# więc przyciski działają po restarcie i nic nie trzyma widoku w pamięci.
+_B = discord.ButtonStyle
+PANELS: Dict[str, Tuple[SessionStore, Dict[str, Callable[[dict], discord.ui.Modal]], Callable[[Optional[discord.Guild], dict, bool], discord.Embed]]] = {
+    "patronat": (SESS, {"1": SpendingModal1, "2": SpendingModal2, "lvl": StateModal}, _embed),
+    "liga": (LIGA, {"1": L1, "2": L2}, lambda g, s, saved: _liga_embed(g, s)),
+}
+PANEL_BUTTONS: Dict[str, List[Tuple[str, str, discord.ButtonStyle, str]]] = {
+    "patronat": [("1","1",_B.primary,"🧾"), ("2","2",_B.primary,"💰"), ("lvl","LVL dekoracji",_B.secondary,"🧭"),
+                 ("save","Zapisz",_B.success,"🔄"), ("reset","Wyczyść",_B.danger,"🧹")],
+    "liga": [("1","1",_B.primary,"🎖️"), ("2","2",_B.primary,"🏅"), ("save","Zapisz",_B.success,"🔄"), ("reset","Wyczyść",_B.danger,"🧹")],
+}
+
+class PanelButton(discord.ui.DynamicItem[discord.ui.Button], template=r"panel:(?P<kind>[a-z]+):(?P<action>[a-z0-9]+):(?P<uid>[0-9]+)"):
+    def __init__(self, kind: str, action: str, uid: int):
+        _, label, style, emoji = next(b for b in PANEL_BUTTONS[kind] if b[0] == action)
+        super().__init__(discord.ui.Button(label=label, style=style, emoji=emoji, custom_id=f"panel:{kind}:{action}:{uid}"))
+        self.kind = kind; self.action = action; self.uid = uid
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(match["kind"], match["action"], int(match["uid"]))
+
+    async def interaction_check(self, i: discord.Interaction) -> bool:
+        if i.user.id != self.uid:
             await i.response.send_message("To prywatny panel innego użytkownika.",ephemeral=True)
             return False
         return True
-    @discord.ui.button(label="1",style=discord.ButtonStyle.primary,emoji="🧾")
-    async def b1(self,i,_): await i.response.send_modal(SpendingModal1(_s(self.uid)))
-    @discord.ui.button(label="2",style=discord.ButtonStyle.primary,emoji="💰")
-    async def b2(self,i,_): await i.response.send_modal(SpendingModal2(_s(self.uid)))
-    @discord.ui.button(label="LVL dekoracji",style=discord.ButtonStyle.secondary,emoji="🧭")
-    async def b3(self,i,_): await i.response.send_modal(StateModal(_s(self.uid)))
-    @discord.ui.button(label="Zapisz",style=discord.ButtonStyle.success,emoji="🔄")
-    async def b4(self,i,_): await i.response.edit_message(embed=_embed(i.guild,_s(self.uid),True),view=self)
-    @discord.ui.button(label="Wyczyść",style=discord.ButtonStyle.danger,emoji="🧹")
-    async def b5(self,i,_): SESS[self.uid]=_new_s(); await i.response.edit_message(embed=_embed(i.guild,_s(self.uid),False),view=self)
+
+    @METRICS.timed("panel:button")
+    async def callback(self, i: discord.Interaction):
+        store, modals, render = PANELS[self.kind]
+        if self.action in modals:
+            await i.response.send_modal(modals[self.action](await store.get(self.uid)))
+        elif self.action == "save":
+            await i.response.edit_message(embed=render(i.guild, await store.get(self.uid), True))
+        elif self.action == "reset":
+            await i.response.edit_message(embed=render(i.guild, await store.reset(self.uid), False))
+
+def panel_view(kind: str, uid: int) -> discord.ui.View:
+    view = discord.ui.View(timeout=None)
+    for action, *_ in PANEL_BUTTONS[kind]:
+        view.add_item(PanelButton(kind, action, uid))
+    # zatrzymany widok służy tylko do zbudowania komponentów — discord.py go nie zapamięta,
+    # a kliknięcia obsługuje PanelButton zarejestrowany w setup_hook
+    view.stop()
+    return view
 
 client = MyClient()
 
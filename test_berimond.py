@@ -0,0 +1,23 @@
+import random
+import pytest
+import bot
+
+@pytest.mark.parametrize("start", range(0, 400_000, 50_000))
+def test_berimond_days_many_matches_per_threshold(start):
+    th = bot.BERI_THRESHOLDS
+    for cur in range(start, start + 50_000, 7):
+        assert bot.berimond_days_many(cur, th) == [bot.days_until_below_berimond(cur, t) for t in th], cur
+
+@pytest.mark.parametrize("seed", range(8))
+def test_berimond_days_many_random_thresholds(seed):
+    # próg 0 wywraca także pierwotną funkcję (log(0)), więc losujemy od 1
+    rnd = random.Random(seed)
+    for _ in range(2_000):
+        cur = rnd.randrange(0, 2_000_000)
+        th = [rnd.choice([rnd.randrange(1, 400_000), 45_000, 95_000, 145_000, cur]) for _ in range(rnd.randrange(1, 6))]
+        assert bot.berimond_days_many(cur, th) == [bot.days_until_below_berimond(cur, t) for t in th], (cur, th)
+
+def test_berimond_days_batch():
+    rows = list(range(0, 300_000, 997))
+    assert bot.berimond_days_batch(rows) == [bot.berimond_days_many(c) for c in rows]
+    assert bot.berimond_days_many(123_456, []) == []
@@ -0,0 +1,71 @@
+import random
+import pytest
+import bot
+
+def _walk_levels_stepwise(lv, prog, gain):
+    C = bot.LEVEL_COSTS
+    lv = max(0, min(10, int(lv))); prog = float(max(0, prog)); pool = float(max(0, gain))
+    if lv >= 10: return 10, 0.0, None, prog + pool
+    while lv < 10:
+        need = C[lv] - prog
+        if pool >= need:
+            pool -= need; lv += 1; prog = 0.0
+        else:
+            prog += pool; pool = 0.0; break
+        if lv == 10: return 10, 0.0, None, pool
+    return lv, prog, (C[lv] - prog if lv < 10 else None), None
+
+def _points_to_level_stepwise(lv, prog, target):
+    if lv >= 10: return 0
+    need = bot.LEVEL_COSTS[lv] - prog
+    for L in range(lv + 1, target):
+        need += bot.LEVEL_COSTS[L]
+    return need
+
+def _level_from_points_stepwise(pts, base=0):
+    lv = max(0, min(10, int(base))); pts = float(max(0, pts))
+    while lv < 10 and pts >= bot.LEVEL_COSTS[lv]:
+        pts -= bot.LEVEL_COSTS[lv]; lv += 1
+    return lv, pts
+
+def _cases(seed, n=5_000):
+    rnd = random.Random(seed)
+    for i in range(n):
+        lv = rnd.randrange(-1, 12); prog = rnd.choice([0, rnd.randrange(30_000), rnd.random() * 30_000])
+        gain = rnd.choice([0, rnd.randrange(100_000), rnd.random() * 100_000])
+        if i % 5 == 0:
+            # dokładnie na granicy poziomu i o punkt obok — tu prefiksy najłatwiej rozjechać z pętlą
+            gain = float(bot.LEVEL_CUM[rnd.randrange(11)] - bot.LEVEL_CUM[max(0, min(10, lv))] + rnd.choice([0, 1, -1])) - prog
+        yield lv, prog, gain
+
+@pytest.mark.parametrize("seed", range(8))
+def test_walk_levels_matches_stepwise(seed):
+    for lv, prog, gain in _cases(seed):
+        assert bot.walk_levels(lv, prog, gain) == _walk_levels_stepwise(lv, prog, gain), (lv, prog, gain)
+
+@pytest.mark.parametrize("seed", range(8))
+def test_points_to_level_matches_stepwise(seed):
+    rnd = random.Random(seed)
+    for lv, prog, gain in _cases(seed):
+        lv2, prog2, left, _ = bot.walk_levels(lv, prog, gain)
+        if left is None:
+            continue
+        target = rnd.randrange(0, 11)
+        assert bot.points_to_level(lv2, prog2, target) == pytest.approx(_points_to_level_stepwise(lv2, prog2, target), rel=1e-9, abs=1e-9)
+
+@pytest.mark.parametrize("seed", range(8))
+def test_level_from_points_matches_stepwise(seed):
+    rnd = random.Random(seed)
+    for _ in range(5_000):
+        base = rnd.randrange(-1, 12)
+        b = max(0, min(10, base))
+        pts = rnd.choice([rnd.randrange(-10, 90_000), rnd.random() * 90_000, bot.LEVEL_CUM[rnd.randrange(b, 11)] - bot.LEVEL_CUM[b] + rnd.choice([0, 1, -1])])
+        assert bot.level_from_points(pts, base) == _level_from_points_stepwise(pts, base), (pts, base)
+
+def test_walk_levels_round_trip():
+    # dojście do celu kosztem z points_to_level ląduje dokładnie na początku tego poziomu
+    for lv in range(10):
+        for target in range(lv + 1, 11):
+            cost = bot.points_to_level(lv, 0.0, target)
+            got = bot.walk_levels(lv, 0.0, cost)
+            assert got[0] == target and got[1] == 0.0
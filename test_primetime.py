@@ -0,0 +1,56 @@
+import math
+import asyncio
+import pytest
+import bot
+import bench
+
+try:
+    import pytest_benchmark  # noqa: F401
+    HAVE_BENCHMARK = True
+except ImportError:
+    HAVE_BENCHMARK = False
+
+@pytest.fixture
+def run(request, tmp_path):
+    # z pytest-benchmark scenariusz jest też mierzony; bez niego po prostu się wykonuje
+    def go(scenario, *args):
+        call = lambda: asyncio.run(scenario(*args, state_path=str(tmp_path / "state.sqlite3")))
+        if HAVE_BENCHMARK:
+            return request.getfixturevalue("benchmark").pedantic(call, rounds=1, iterations=1)
+        return call()
+    return go
+
+def _pages(users: int) -> int:
+    return max(1, math.ceil(users / 100))
+
+@pytest.mark.parametrize("n", [10, 1_000])
+def test_ping_clear_reaction(run, n):
+    rest, g, _, _ = run(bench.ping_scenario, n, True)
+    assert rest.calls == {"DELETE member role": n, "DELETE reaction emoji": 1, "PUT reaction": 1, "POST message": 1}
+    assert not g.roles[bot.ROLE_PREMKA300].members
+
+@pytest.mark.parametrize("n", [10, 1_000])
+def test_ping_per_user(run, n):
+    rest, g, _, _ = run(bench.ping_scenario, n, False)
+    assert rest.calls == {"DELETE member role": n, "DELETE reaction user": n, "POST message": 1}
+    assert not g.roles[bot.ROLE_PREMKA300].members
+
+@pytest.mark.parametrize("n", [10, 1_000])
+def test_sync_only_diff(run, n):
+    rest, g, _ = run(bench.sync_scenario, n)
+    diff = n // 10
+    msg = g.channels[bot.SIGNUP_CHANNEL_ID].messages[0]
+    assert rest.calls == {"PUT member role": diff, "DELETE member role": diff, "GET message": 1,
+                          "GET reactions": sum(_pages(len(r.users_)) for r in msg.reactions)}
+
+def test_burst_pings_each_kind_once(run):
+    rest, g, _ = run(bench.burst_scenario, 1_000, 500)
+    assert len(g.channels[bot.EM_CHANNEL_ID].sent) == 3
+    assert rest.calls["POST message"] == 3
+    assert rest.calls["DELETE member role"] == 1_000
+
+def test_startup_pings_missed_em(run):
+    rest, g, _, first = run(bench.startup_scenario, 1_000)
+    assert first is not None
+    assert rest.calls["POST message"] == 1
+    assert rest.calls["DELETE member role"] == 1_000